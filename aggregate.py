@@ -0,0 +1,96 @@
+# Windowed aggregation of sensor samples
+#
+# Weather Display sends a packet every second. Rather than throwing most of
+# them away, every sample is pushed into a per-field window and the window
+# is reduced to a single value (mean, min, max or last) when it's time to
+# publish.
+
+from array import array
+
+MODES = ('mean', 'min', 'max', 'last')
+
+NAN = float('nan')
+
+# Fields where the last value would hide what happened during the window.
+DEFAULT_MODES = {
+        'wind-gustspeed' : 'max',
+        'rain-maxrate' : 'max',
+        'lightning-strikes' : 'max',
+        }
+
+
+class FieldWindow(object):
+    """
+    Fixed-size ring buffer of samples for one mapped field along with
+    running statistics for the current window. Pushing a sample is O(1);
+    the statistics cover every sample since the last reset even when the
+    ring has wrapped.
+
+    A packet without a value for the field is recorded in the ring as NaN
+    by skip(), leaving the statistics alone, so the rings of fields used
+    together (see derived.py) stay one entry per packet.
+    """
+    __slots__ = ('mode', 'capacity', 'samples', 'head', 'count', 'held',
+            'total', 'low', 'high', 'last')
+
+    def __init__(self, mode='last', capacity=64):
+        if mode not in MODES:
+            raise ValueError('Unknown aggregation mode ' + str(mode))
+        self.mode = mode
+        self.capacity = capacity
+        self.samples = array('d', [0.0]) * capacity
+        self.head = 0
+        self.reset()
+
+    def reset(self):
+        self.count = 0      # samples in the window
+        self.held = 0       # ring entries in the window, gaps included
+        self.total = 0.0
+        self.low = None
+        self.high = None
+        self.last = None
+
+    def push(self, value):
+        self.samples[self.head] = value
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+
+        if self.count == 0:
+            self.low = value
+            self.high = value
+        elif value < self.low:
+            self.low = value
+        elif value > self.high:
+            self.high = value
+        self.count += 1
+        self.held += 1
+        self.total += value
+        self.last = value
+
+    def skip(self):
+        self.samples[self.head] = NAN
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        self.held += 1
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.mode == 'mean':
+            return self.total / self.count
+        if self.mode == 'min':
+            return self.low
+        if self.mode == 'max':
+            return self.high
+        return self.last
+
+    def values(self):
+        # The samples held in the ring for the current window, oldest
+        # first. Gaps are NaN.
+        n = min(self.held, self.capacity)
+        start = self.head - n
+        if start >= 0:
+            return self.samples[start:self.head]
+        return self.samples[start:] + self.samples[:self.head]
@@ -0,0 +1,213 @@
+# Local HTTP API
+#
+# Read only JSON access to the current values so dashboards and scripts
+# don't have to poll the ISY for them:
+#   GET /values            - every node
+#   GET /values/<address>  - one node
+#   GET /metrics           - the runtime metrics (see metrics.py)
+#   GET /history?series=<address>/<driver>&start=<time>&end=<time>[&tier=1m]
+#                          - recorded values, when History is enabled
+#
+# The publisher rebuilds the cache once per publish cycle: each response
+# body is encoded then, along with its ETag, and swapped in with a single
+# assignment. Requests are served on the receive loop from those encoded
+# bodies, so answering one is a dictionary lookup and a write. A client
+# that sends If-None-Match with the current ETag gets a 304 with no body.
+# The ETag only changes when the values do.
+#
+# History queries go to the database so they're run on a worker thread,
+# not the loop.
+
+import asyncio
+import json
+import time
+import zlib
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs
+
+# Largest request header accepted, and how long an idle keep-alive
+# connection is held open.
+MAX_HEADER = 8192
+IDLE_TIMEOUT = 30
+
+REASONS = {
+        200: 'OK',
+        304: 'Not Modified',
+        400: 'Bad Request',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+        500: 'Internal Server Error',
+        }
+
+
+class Document(object):
+    """ An encoded response body with its validators. """
+    __slots__ = ('body', 'etag', 'modified')
+
+    def __init__(self, body, etag, modified):
+        self.body = body
+        self.etag = etag
+        self.modified = modified
+
+
+def encode(data):
+    return json.dumps(data, separators=(',', ':'), sort_keys=True).encode()
+
+
+def document(body, old=None, now=None):
+    # Keep the old validators if the content hasn't changed.
+    if old is not None and old.body == body:
+        return old
+    etag = '"%08x-%x"' % (zlib.crc32(body), len(body))
+    return Document(body, etag, formatdate(now or time.time(), usegmt=True))
+
+
+class Cache(object):
+    def __init__(self):
+        self.values = None  # Document of all the nodes
+        self.nodes = {}     # address -> Document
+
+    def update(self, nodes, now=None):
+        """
+        Rebuild from the nodes' drivers. Called on the publisher thread,
+        which is the only one that changes the drivers.
+        """
+        data = {}
+        for node in nodes:
+            reported = getattr(node, 'reported', {})
+            latest = getattr(node, 'latest', {})
+            drivers = {}
+            for d in node.drivers:
+                entry = {'value': d['value'], 'uom': d['uom']}
+                if d['driver'] in reported:
+                    entry['time'] = reported[d['driver']][1]
+                if d['driver'] in latest:
+                    # Most recent aggregated value, which may not have
+                    # been sent to the ISY if it was within the deadband.
+                    entry['latest'] = latest[d['driver']]
+                drivers[d['driver']] = entry
+            data[node.address] = {'name': node.name, 'drivers': drivers}
+
+        nodes = {}
+        for address, node in data.items():
+            nodes[address] = document(encode(node), self.nodes.get(address), now)
+        values = document(encode(data), self.values, now)
+        # Readers only ever look at these two attributes.
+        self.nodes = nodes
+        self.values = values
+
+
+class Server(object):
+    def __init__(self, cache, logger, metrics=None, history=None):
+        self.cache = cache
+        self.logger = logger
+        self.metrics = metrics
+        self.history = history  # function returning the History or None
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+        # One connection; requests are handled in turn until the client
+        # closes it, asks to or goes idle.
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                if len(head) > MAX_HEADER:
+                    break
+                keep_alive = await self.request(head, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            # Closed by the client or the loop is shutting down.
+            pass
+        except Exception as e:
+            self.logger.error('API request failed: {}'.format(e), exc_info=True)
+        finally:
+            writer.close()
+
+    async def request(self, head, writer):
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3:
+            self.respond(writer, 400, b'', False)
+            return False
+        (method, target, version) = parts
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                (name, value) = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        self.requests += 1
+        if method not in ('GET', 'HEAD'):
+            self.respond(writer, 405, encode({'error': 'read only'}), keep_alive)
+            return keep_alive
+
+        url = urlsplit(target)
+        path = url.path.rstrip('/') or '/values'
+        if path == '/values':
+            doc = self.cache.values
+        elif path.startswith('/values/'):
+            doc = self.cache.nodes.get(path[8:])
+        elif path == '/metrics' and self.metrics is not None:
+            doc = document(encode(self.metrics.snapshot()))
+        elif path == '/history':
+            (status, body) = await self.query_history(parse_qs(url.query))
+            self.respond(writer, status, body, keep_alive, head=method == 'HEAD')
+            return keep_alive
+        else:
+            doc = None
+
+        if doc is None:
+            self.respond(writer, 404, encode({'error': 'not found'}), keep_alive)
+        elif doc.etag in headers.get('if-none-match', ''):
+            self.respond(writer, 304, b'', keep_alive, doc)
+        else:
+            self.respond(writer, 200, doc.body, keep_alive, doc, method == 'HEAD')
+        return keep_alive
+
+    async def query_history(self, query):
+        store = self.history() if self.history is not None else None
+        if store is None:
+            return (404, encode({'error': 'history is not enabled'}))
+        try:
+            name = query['series'][0]
+            end = float(query.get('end', [time.time()])[0])
+            start = float(query.get('start', [end - 3600])[0])
+            tier = query.get('tier', [None])[0]
+        except (KeyError, ValueError):
+            return (400, encode({'error': 'series, start and end are needed'}))
+        loop = asyncio.get_event_loop()
+        try:
+            rows = await loop.run_in_executor(None, store.query, name, start, end, tier)
+        except ValueError as e:
+            return (400, encode({'error': str(e)}))
+        except Exception as e:
+            self.logger.error('History query failed: {}'.format(e))
+            return (500, encode({'error': 'query failed'}))
+        return (200, encode({'series': name, 'tier': tier, 'values': rows}))
+
+    def respond(self, writer, status, body, keep_alive, doc=None, head=False):
+        lines = [
+                'HTTP/1.1 %d %s' % (status, REASONS[status]),
+                'Content-Type: application/json',
+                'Cache-Control: no-cache',
+                'Connection: ' + ('keep-alive' if keep_alive else 'close'),
+                ]
+        if doc is not None:
+            lines.append('ETag: ' + doc.etag)
+            lines.append('Last-Modified: ' + doc.modified)
+        if status != 304:
+            lines.append('Content-Length: %d' % len(body))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if status != 304 and not head:
+            writer.write(body)
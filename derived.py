@@ -0,0 +1,185 @@
+# Derived weather values
+#
+# Calculates dewpoint, wind chill, heat index, apparent temperature and
+# sea level pressure from the raw temperature, humidity, wind speed and
+# station pressure samples. Each formula is written once against a small
+# math namespace so it can be evaluated either over a whole aggregation
+# window at once with NumPy (when it's installed) or one sample at a time
+# with the math module.
+#
+# Inputs are in the units Weather Display sends: Celsius, percent, knots
+# and millibars. Results are Celsius and millibars.
+#
+# NumPy takes a while to import so it's only loaded the first time a
+# window is evaluated, not when the node server starts.
+
+import math
+
+numpy = None
+_loaded = False
+
+
+def load_numpy():
+    global numpy, _loaded
+    if not _loaded:
+        _loaded = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+KNOTS_TO_MS = 0.514444
+
+NAN = float('nan')
+
+
+class _Scalar(object):
+    exp = staticmethod(math.exp)
+    log = staticmethod(math.log)
+    power = staticmethod(math.pow)
+    maximum = staticmethod(max)
+
+    @staticmethod
+    def where(cond, a, b):
+        return a if cond else b
+
+SCALAR = _Scalar()
+
+
+def dewpoint(xp, t, h):
+    b = (17.625 * t) / (243.04 + t)
+    c = xp.log(xp.maximum(h, 1.0) / 100.0)
+    return (243.04 * (c + b)) / (17.625 - c - b)
+
+
+def apparent(xp, t, knots, h):
+    ws = knots * KNOTS_TO_MS
+    wv = h / 100.0 * 6.105 * xp.exp(17.27 * t / (237.7 + t))
+    return t + (0.33 * wv) - (0.70 * ws) - 4.0
+
+
+def windchill(xp, t, knots):
+    # really need temp in F and speed in MPH
+    tf = (t * 1.8) + 32
+    mph = knots * KNOTS_TO_MS / 0.44704
+    v = xp.power(mph, 0.16)
+    wc = 35.74 + (0.6215 * tf) - (35.75 * v) + (0.4275 * tf * v)
+    return xp.where((tf <= 50.0) & (mph >= 5.0), (wc - 32) / 1.8, t)
+
+
+def heatindex(xp, t, h):
+    tf = (t * 1.8) + 32
+    c1 = -42.379
+    c2 = 2.04901523
+    c3 = 10.1433127
+    c4 = -0.22475541
+    c5 = -6.83783e-3
+    c6 = -5.481717e-2
+    c7 = 1.22874e-3
+    c8 = 8.5282e-4
+    c9 = -1.99e-6
+
+    hi = (c1 + (c2 * tf) + (c3 * h) + (c4 * tf * h) + (c5 * tf * tf) + (c6 * h * h) + (c7 * tf * tf * h) + (c8 * tf * h * h) + (c9 * tf * tf * h * h))
+    return xp.where((tf < 80.0) | (h < 40.0), t, (hi - 32) / 1.8)
+
+
+# convert station pressure in millibars to sealevel pressure
+def sealevel(xp, station, elevation):
+    i = 287.05
+    a = 9.80665
+    r = 0.0065
+    s = 1013.35 # pressure at sealevel
+    n = 288.15
+
+    l = a / (i * r)
+    c = i * r / a
+    # A pressure of zero or less isn't a reading, make it a NaN result.
+    station = xp.where(station > 0, station, NAN)
+    return station * xp.power(1 + xp.power(s / station, c) * (r * elevation / n), l)
+
+
+# Raw inputs, named by the node and driver they're mapped to.
+SOURCES = {
+        't' : ('temperature', 'ST'),
+        'h' : ('humidity', 'ST'),
+        'ws' : ('wind', 'ST'),
+        'p' : ('pressure', 'ST'),
+        }
+
+# (node, driver) -> (function, inputs)
+METRICS = {
+        ('temperature', 'GV0') : (dewpoint, ('t', 'h')),
+        ('temperature', 'GV1') : (windchill, ('t', 'ws')),
+        ('temperature', 'GV2') : (heatindex, ('t', 'h')),
+        ('temperature', 'GV3') : (apparent, ('t', 'ws', 'h')),
+        ('pressure', 'GV0') : (sealevel, ('p',)),
+        }
+
+
+def evaluate(func, series, *extra):
+    """
+    Apply func to every sample of the input series, skipping the packets
+    where any input is a gap (NaN).
+    """
+    numpy = load_numpy()
+    if numpy is not None:
+        arrays = [numpy.frombuffer(s, dtype='d') for s in series]
+        present = ~numpy.isnan(arrays[0])
+        for a in arrays[1:]:
+            present &= ~numpy.isnan(a)
+        if not present.all():
+            arrays = [a[present] for a in arrays]
+        return func(numpy, *(arrays + list(extra)))
+    return [func(SCALAR, *(list(v) + list(extra))) for v in zip(*series)
+            if all(x == x for x in v)]
+
+
+def finite(values):
+    """ The values that are neither NaN nor infinite. """
+    numpy = load_numpy()
+    if numpy is not None:
+        values = numpy.asarray(values, dtype='d')
+        return values[numpy.isfinite(values)]
+    return [v for v in values if math.isfinite(v)]
+
+
+def reduce(values, mode):
+    if len(values) == 0:
+        return None
+    if mode == 'min':
+        return float(min(values))
+    if mode == 'max':
+        return float(max(values))
+    if mode == 'last':
+        return float(values[-1])
+    numpy = load_numpy()
+    if numpy is not None:
+        return float(numpy.mean(values))
+    return sum(values) / len(values)
+
+
+class DerivedWindow(object):
+    """
+    Window style wrapper that calculates a derived value from the samples
+    held by the source windows. The source windows get one entry per
+    packet, a sample or a gap, so their newest entries line up.
+    """
+    def __init__(self, func, sources, mode='mean', extra=()):
+        self.func = func
+        self.sources = sources
+        self.mode = mode
+        self.extra = extra
+
+    def value(self):
+        n = min(min(w.held, w.capacity) for w in self.sources)
+        if n == 0:
+            return None
+        series = []
+        for w in self.sources:
+            v = w.values()
+            series.append(v[len(v) - n:])
+        return reduce(finite(evaluate(self.func, series, *self.extra)), self.mode)
+
+    def reset(self):
+        pass
@@ -0,0 +1,136 @@
+# Highs and lows
+#
+# Tracks the minimum and maximum of a field, with the time each happened,
+# over three periods:
+#   daily   - since local midnight
+#   rolling - the last 24 hours
+#   alltime - since tracking started (kept across restarts)
+#
+# Every sample from Weather Display is used, not just the published ones.
+# Daily and all time are a comparison each. The rolling window uses a
+# monotonic deque for each of min and max, which only keeps the samples
+# that could still become the extreme, so a push is O(1) amortized and
+# the current extreme is always at the front. Sample times are rounded to
+# RESOLUTION seconds so a deque never holds more than one entry per
+# RESOLUTION seconds of the window.
+
+import collections
+import time
+import rain
+
+PERIODS = ('daily', 'rolling', 'alltime')
+
+RESOLUTION = 60
+
+
+class RollingExtreme(object):
+    """ Maximum (or minimum, with sign=-1) over the last span seconds. """
+    def __init__(self, span=86400, sign=1):
+        self.span = span
+        self.sign = sign
+        self.entries = collections.deque()  # (time, signed value), values decreasing
+
+    def push(self, value, now):
+        v = value * self.sign
+        t = now - now % RESOLUTION
+        entries = self.entries
+        while entries and entries[-1][1] <= v:
+            entries.pop()
+        if not entries or entries[-1][0] != t:
+            entries.append((t, v))
+        cutoff = now - self.span
+        while entries[0][0] <= cutoff:
+            entries.popleft()
+
+    def value(self):
+        # (value, time) or None
+        if not self.entries:
+            return None
+        (t, v) = self.entries[0]
+        return (v * self.sign, t)
+
+    def get_state(self):
+        return [list(e) for e in self.entries]
+
+    def set_state(self, entries):
+        self.entries = collections.deque((float(t), float(v)) for (t, v) in entries)
+
+
+class Extremes(object):
+    def __init__(self, periods=PERIODS, now=None):
+        if now is None:
+            now = time.time()
+        self.periods = periods
+        self.daily = {'min': None, 'max': None}     # kind -> (value, time)
+        self.alltime = {'min': None, 'max': None}
+        self.rolling = {
+                'min': RollingExtreme(sign=-1),
+                'max': RollingExtreme(sign=1),
+                }
+        self.midnight = rain.next_boundary('day', now)
+        self.dirty = False
+
+    def push(self, value, now=None):
+        if now is None:
+            now = time.time()
+        if now >= self.midnight:
+            self.daily = {'min': None, 'max': None}
+            self.midnight = rain.next_boundary('day', now)
+
+        for table in (self.daily, self.alltime):
+            low = table['min']
+            if low is None or value < low[0]:
+                table['min'] = (value, now)
+                self.dirty = True
+            high = table['max']
+            if high is None or value > high[0]:
+                table['max'] = (value, now)
+                self.dirty = True
+
+        if 'rolling' in self.periods:
+            self.rolling['min'].push(value, now)
+            self.rolling['max'].push(value, now)
+            self.dirty = True
+
+    def get(self, period, kind):
+        """ (value, time) of the period's min or max, or None. """
+        if period == 'rolling':
+            return self.rolling[kind].value()
+        if period == 'daily':
+            if time.time() >= self.midnight:
+                return None
+            return self.daily[kind]
+        return self.alltime[kind]
+
+    def get_state(self):
+        return {
+                'daily': self.daily,
+                'midnight': self.midnight,
+                'alltime': self.alltime,
+                'rolling': dict((k, r.get_state()) for k, r in self.rolling.items()),
+                }
+
+    def set_state(self, state):
+        def pair(p):
+            return None if p is None else (float(p[0]), float(p[1]))
+        for kind in ('min', 'max'):
+            self.alltime[kind] = pair(state['alltime'][kind])
+            self.rolling[kind].set_state(state['rolling'][kind])
+        if time.time() < state['midnight']:
+            self.daily = dict((k, pair(state['daily'][k])) for k in ('min', 'max'))
+            self.midnight = state['midnight']
+
+
+class Extreme(object):
+    """ Window style view of one of the tracked values, for the plan. """
+    def __init__(self, tracker, period, kind):
+        self.tracker = tracker
+        self.period = period
+        self.kind = kind
+
+    def value(self):
+        v = self.tracker.get(self.period, self.kind)
+        return None if v is None else v[0]
+
+    def reset(self):
+        pass
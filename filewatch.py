@@ -0,0 +1,135 @@
+# clientraw.txt file input
+#
+# Weather Display writes (or uploads) clientraw.txt every few seconds,
+# which works even where the UDP broadcast isn't enabled. The file holds
+# the same space separated fields as a UDP packet so its contents go
+# through the same packet handling.
+#
+# On Linux the file's directory is watched with inotify (through ctypes,
+# there's no extra package to install) and the inotify descriptor is
+# registered with the receive loop, so a finished write, or a new copy
+# renamed into place, is picked up straight away. The file's size and
+# modification time are also checked every few seconds: inotify isn't
+# available everywhere and, on a network share, it doesn't report writes
+# made by other machines (Weather Display on Windows writing to a share
+# mounted here) even though setting up the watch works.
+#
+# The file is only read when its size or mtime has changed and the
+# contents are only passed on when they differ from the last read, so
+# the regular check costs a stat().
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import zlib
+import receiver
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct('iIII')
+
+# Largest file accepted, a clientraw.txt is around 1k.
+MAX_SIZE = 65536
+
+_libc = None
+
+
+def inotify_libc():
+    # The C library, if it has inotify, otherwise None.
+    global _libc
+    if _libc is None:
+        _libc = False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            _libc = libc
+        except (OSError, AttributeError):
+            pass
+    return _libc or None
+
+
+class FileSource(receiver.Input):
+    """ A watched file. """
+    def __init__(self, path, handler, interval=2.0, inotify=True):
+        self.path = os.path.abspath(path)
+        super(FileSource, self).__init__(self.path, handler)
+        self.interval = interval
+        self.fd = None
+        self.stat = None    # (size, mtime) at the last read
+        self.crc = None     # of the contents at the last read
+        self.reads = 0
+        self.unchanged = 0  # reads skipped or thrown away as the same
+        self.dirname = os.path.dirname(self.path)
+        self.basename = os.fsencode(os.path.basename(self.path))
+        if inotify:
+            self.fd = self.watch()
+
+    def watch(self):
+        # Watch the directory rather than the file so a file that's
+        # replaced (written to a temporary file and renamed, or deleted and
+        # uploaded again) is still seen.
+        libc = inotify_libc()
+        if libc is None:
+            return None
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, os.fsencode(self.dirname), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def fileno(self):
+        return self.fd
+
+    def events(self):
+        # True if the watched file was among the events waiting on the
+        # inotify descriptor.
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return False
+        found = False
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            (wd, mask, cookie, length) = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name == self.basename or mask & IN_Q_OVERFLOW:
+                found = True
+        return found
+
+    def read(self):
+        """ The file's contents if they've changed, otherwise None. """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        stat = (st.st_size, st.st_mtime_ns)
+        if stat == self.stat or st.st_size == 0 or st.st_size > MAX_SIZE:
+            self.unchanged += 1
+            return None
+        with open(self.path, 'rb') as f:
+            data = f.read(MAX_SIZE)
+        self.stat = stat
+        self.reads += 1
+        crc = zlib.crc32(data)
+        if crc == self.crc:
+            self.unchanged += 1
+            return None
+        self.crc = crc
+        return data
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
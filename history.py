@@ -0,0 +1,220 @@
+# Value history
+#
+# Keeps the history of every mapped field in an SQLite database (in WAL
+# mode so readers don't block the writer) in three tiers:
+#   1s - every sample, the last one in each second
+#   1m - count, sum, min and max per minute
+#   1h - count, sum, min and max per hour
+# each with its own retention.
+#
+# The packet handler only appends (time, [(series, value)]) to a deque; a
+# writer thread drains it every few seconds and writes the whole batch in
+# one transaction, rolling the minute and hour aggregates up in memory as
+# it goes. Old rows are trimmed once a minute.
+#
+# Series are named <node address>/<driver> and values are stored in the
+# units Weather Display sends.
+
+import collections
+import sqlite3
+import threading
+import time
+
+TIERS = ('1s', '1m', '1h')
+BUCKET = {'1s': 1, '1m': 60, '1h': 3600}
+
+# Default days to keep each tier
+RETENTION = {'1s': 1, '1m': 30, '1h': 1825}
+
+# Samples waiting to be written beyond this are dropped (and counted).
+MAX_PENDING = 1000000
+
+SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS tier_1s (series INTEGER, t INTEGER, v REAL, '
+            'PRIMARY KEY (series, t)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS tier_1m (series INTEGER, t INTEGER, n INTEGER, '
+            'sum REAL, min REAL, max REAL, PRIMARY KEY (series, t)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS tier_1h (series INTEGER, t INTEGER, n INTEGER, '
+            'sum REAL, min REAL, max REAL, PRIMARY KEY (series, t)) WITHOUT ROWID',
+        )
+
+
+class History(object):
+    def __init__(self, path, logger, retention=None, interval=5):
+        self.path = path
+        self.logger = logger
+        self.retention = dict(RETENTION, **(retention or {}))
+        self.interval = interval
+        self.pending = collections.deque()
+        self.dropped = 0
+        self.written = 0
+        self.ids = {}          # series name -> id
+        self.new_series = []   # (id, name) not yet in the database
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        # series -> [bucket start, n, sum, min, max] being built
+        self.building = {'1m': {}, '1h': {}}
+        self.last_trim = 0
+
+        db = self.connect()
+        try:
+            for statement in SCHEMA:
+                db.execute(statement)
+            db.commit()
+            for (sid, name) in db.execute('SELECT id, name FROM series'):
+                self.ids[name] = sid
+        finally:
+            db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def series_id(self, name):
+        with self.lock:
+            sid = self.ids.get(name)
+            if sid is None:
+                sid = max(list(self.ids.values()) + [0]) + 1
+                self.ids[name] = sid
+                self.new_series.append((sid, name))
+            return sid
+
+    def add(self, now, values):
+        # values is a list of (series id, value). Called for every packet,
+        # so it does as little as possible.
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += len(values)
+            return
+        self.pending.append((now, values))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run(self):
+        db = self.connect()
+        try:
+            while not self.stopping.wait(self.interval):
+                self.write(db, time.time())
+            self.write(db, time.time(), final=True)
+        except sqlite3.Error as e:
+            self.logger.error('History writer failed: {}'.format(e), exc_info=True)
+        finally:
+            db.close()
+
+    def write(self, db, now, final=False):
+        with self.lock:
+            series = self.new_series
+            self.new_series = []
+
+        rows = []
+        done = {'1m': [], '1h': []}
+        pending = self.pending
+        for n in range(len(pending)):
+            (t, values) = pending.popleft()
+            second = int(t)
+            for (sid, v) in values:
+                rows.append((sid, second, v))
+                for tier in ('1m', '1h'):
+                    self.roll(tier, sid, second, v, done[tier])
+
+        if final:
+            # Save the partial buckets, they're merged with the rest of
+            # the bucket on the next run.
+            for tier in ('1m', '1h'):
+                done[tier].extend([sid] + b for sid, b in self.building[tier].items())
+                self.building[tier] = {}
+
+        with db:
+            if series:
+                db.executemany('INSERT OR IGNORE INTO series (id, name) VALUES (?, ?)', series)
+            db.executemany('INSERT OR REPLACE INTO tier_1s (series, t, v) VALUES (?, ?, ?)', rows)
+            for tier in ('1m', '1h'):
+                for row in done[tier]:
+                    self.merge(db, tier, row)
+            if now - self.last_trim >= 60:
+                self.last_trim = now
+                self.trim(db, now)
+        self.written += len(rows)
+
+    def trim(self, db, now):
+        # One series at a time so each delete is a range of the primary
+        # key rather than a scan of the whole table.
+        with self.lock:
+            ids = list(self.ids.values())
+        for tier in TIERS:
+            cutoff = int(now - self.retention[tier] * 86400)
+            db.executemany('DELETE FROM tier_%s WHERE series = ? AND t < ?' % tier,
+                    [(sid, cutoff) for sid in ids])
+
+    def merge(self, db, tier, row):
+        # Combine with a partial bucket saved by an earlier run. (Done by
+        # hand, ON CONFLICT DO UPDATE needs a newer SQLite than Raspbian
+        # Stretch has.)
+        (sid, start, n, total, low, high) = row
+        old = db.execute('SELECT n, sum, min, max FROM tier_%s WHERE series = ? AND t = ?'
+                % tier, (sid, start)).fetchone()
+        if old is not None:
+            n += old[0]
+            total += old[1]
+            low = min(low, old[2])
+            high = max(high, old[3])
+        db.execute('INSERT OR REPLACE INTO tier_%s (series, t, n, sum, min, max) '
+                'VALUES (?, ?, ?, ?, ?, ?)' % tier, (sid, start, n, total, low, high))
+
+    def roll(self, tier, sid, second, v, done):
+        start = second - second % BUCKET[tier]
+        b = self.building[tier].get(sid)
+        if b is None or b[0] != start:
+            if b is not None:
+                done.append([sid] + b)
+            self.building[tier][sid] = [start, 1, v, v, v]
+            return
+        b[1] += 1
+        b[2] += v
+        if v < b[3]:
+            b[3] = v
+        if v > b[4]:
+            b[4] = v
+
+    def names(self):
+        with self.lock:
+            return sorted(self.ids)
+
+    def query(self, name, start, end, tier=None):
+        """
+        Values of a series between start and end (time stamps). The tier
+        is chosen from the length of the range unless given. Returns a
+        list of (time, value) for the 1s tier and (time, mean, min, max)
+        for the others.
+        """
+        if tier is None:
+            span = end - start
+            tier = '1s' if span <= 7200 else '1m' if span <= 7 * 86400 else '1h'
+        if tier not in TIERS:
+            raise ValueError('Unknown history tier ' + str(tier))
+        with self.lock:
+            sid = self.ids.get(name)
+        if sid is None:
+            return []
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            if tier == '1s':
+                cur = db.execute('SELECT t, v FROM tier_1s WHERE series = ? AND t >= ? '
+                        'AND t <= ? ORDER BY t', (sid, int(start), int(end)))
+            else:
+                cur = db.execute('SELECT t, sum / n, min, max FROM tier_%s WHERE series = ? '
+                        'AND t >= ? AND t <= ? ORDER BY t' % tier, (sid, int(start), int(end)))
+            return cur.fetchall()
+        finally:
+            db.close()
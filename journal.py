@@ -0,0 +1,170 @@
+# Packet journal
+#
+# Append only journal of received packets. Each packet that passed
+# validation is stored exactly as it was received, as a variable length
+# record: the receive time and length followed by the packet's bytes, so
+# appending is a single copy with no parsing on the receive path.
+# Records are written back to back into memory mapped segment files;
+# when a segment is out of records or space a new one is started and the
+# oldest segments beyond the retention limit are removed. A finished
+# segment is cut down to the bytes it holds.
+#
+# Readers map the segments and get each packet as a memoryview into the
+# file, no copying required. values() turns a packet into its field
+# values when they're needed.
+
+import mmap
+import os
+import struct
+
+MAGIC = b'WDJ3'
+HEADER = struct.Struct('<4sIII')  # magic, record capacity, records used, bytes used
+COUNTS = struct.Struct('<II')     # records used, bytes used; at offset 8
+RECORD = struct.Struct('<dI')     # receive time, packet length
+NAN = float('nan')
+
+
+def to_float(s):
+    try:
+        return float(s)
+    except ValueError:
+        return NAN
+
+
+def values(data):
+    """ The fields of a journaled packet as floats, NaN if not a number. """
+    return [to_float(f) for f in bytes(data).split()]
+
+
+class Segment(object):
+    def __init__(self, path, size=16777216, capacity=3600, create=False):
+        self.path = path
+        if create:
+            self.capacity = capacity
+            self.size = size
+            with open(path, 'wb') as f:
+                f.truncate(size)
+            self.file = open(path, 'r+b')
+            self.map = mmap.mmap(self.file.fileno(), 0)
+            self.used = 0
+            self.end = HEADER.size
+            HEADER.pack_into(self.map, 0, MAGIC, capacity, self.used, self.end)
+            self.writable = True
+        else:
+            self.file = open(path, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, self.capacity, self.used, self.end) = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                self.close()
+                raise ValueError('%s is not a journal segment' % path)
+            self.size = len(self.map)
+            self.writable = False
+
+    def full(self):
+        return self.used >= self.capacity
+
+    def room(self):
+        # Largest packet that still fits.
+        return self.size - self.end - RECORD.size
+
+    def append(self, ts, data):
+        # Returns the number of bytes of the packet stored, the packet is
+        # cut short if it doesn't fit.
+        n = max(0, min(len(data), self.room()))
+        RECORD.pack_into(self.map, self.end, ts, n)
+        start = self.end + RECORD.size
+        self.map[start:start + n] = data[:n]
+        self.used += 1
+        self.end = start + n
+        # Only bump the counts once the record is complete.
+        COUNTS.pack_into(self.map, 8, self.used, self.end)
+        return n
+
+    def records(self):
+        # Yield (time, packet) where packet is a memoryview of the bytes
+        # straight out of the mapped file.
+        view = memoryview(self.map)
+        offset = HEADER.size
+        for i in range(self.used):
+            (ts, n) = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            yield (ts, view[start:start + n])
+            offset = start + n
+
+    def close(self):
+        try:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+                if self.writable:
+                    # Give back the space that wasn't used.
+                    self.file.truncate(self.end)
+        finally:
+            self.file.close()
+
+
+class Journal(object):
+    def __init__(self, directory, size=16777216, capacity=3600, segments=24):
+        self.directory = directory
+        self.size = size              # bytes per segment
+        self.capacity = capacity      # records per segment
+        self.segments = segments      # number of segments to keep
+        self.current = None
+        self.truncated = 0            # packets too large to keep whole
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        existing = segment_files(directory)
+        self.sequence = segment_number(existing[-1]) + 1 if existing else 0
+
+    def append(self, ts, data):
+        # True if the whole packet was kept.
+        current = self.current
+        if (current is None or current.full() or
+                (len(data) > current.room() and current.used > 0)):
+            self.rotate()
+        if self.current.append(ts, data) < len(data):
+            self.truncated += 1
+            return False
+        return True
+
+    def rotate(self):
+        if self.current is not None:
+            self.current.close()
+        path = os.path.join(self.directory, 'journal-%08d.wdj' % self.sequence)
+        self.sequence += 1
+        self.current = Segment(path, self.size, self.capacity, create=True)
+
+        # Enforce the retention limit
+        existing = segment_files(self.directory)
+        for name in existing[:max(0, len(existing) - self.segments)]:
+            os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
+def segment_files(directory):
+    return sorted(f for f in os.listdir(directory)
+            if f.startswith('journal-') and f.endswith('.wdj'))
+
+
+def segment_number(name):
+    return int(name[len('journal-'):-len('.wdj')])
+
+
+def read(directory):
+    """ Iterate over (time, packet) for every record in the journal. """
+    for name in segment_files(directory):
+        segment = Segment(os.path.join(directory, name))
+        try:
+            for record in segment.records():
+                yield record
+        finally:
+            # The map can't be closed while the caller still holds views
+            # into it, in that case it's released when they're dropped.
+            try:
+                segment.close()
+            except BufferError:
+                pass
@@ -0,0 +1,157 @@
+# Runtime metrics
+#
+# Counters and timing histograms for the packet pipeline so it's possible
+# to tell whether the node server is keeping up with Weather Display.
+# Recording a sample is a couple of additions and a bit_length(); there's
+# no locking, the counters are only written by the publisher thread.
+#
+# Histograms use power of two buckets in microseconds: bucket n holds the
+# samples from 2^(n-1) up to 2^n us, so percentiles are accurate to within
+# a factor of two, which is plenty to see where the time goes.
+#
+# The timing histograms cover the current publish interval; roll() folds
+# them into the lifetime totals at the end of each interval. The JSON
+# snapshot reports the lifetime totals.
+
+import json
+import os
+import time
+
+BUCKETS = 24  # up to ~8 seconds
+
+# Why packets are rejected:
+#   sender - not from one of the station's allowed senders
+#   short  - fewer fields than the highest mapped field number
+#   header - doesn't start with the clientraw 12345 header
+#   number - a mapped field isn't a number or a placeholder
+REASONS = ('sender', 'short', 'header', 'number')
+
+# The timing histograms.
+TIMINGS = ('parse', 'convert', 'publish')
+
+
+class Histogram(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def merge(self, other):
+        for n, c in enumerate(other.buckets):
+            self.buckets[n] += c
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def add(self, seconds):
+        us = int(seconds * 1000000)
+        self.buckets[min(us.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper bound, in seconds, of the bucket holding the p'th percentile
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for n, c in enumerate(self.buckets):
+            seen += c
+            if seen >= target:
+                return min((1 << n) / 1000000.0, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        return {
+                'count': self.count,
+                'mean_us': round(self.mean() * 1e6, 1),
+                'p50_us': round(self.percentile(50) * 1e6, 1),
+                'p99_us': round(self.percentile(99) * 1e6, 1),
+                'max_us': round(self.max * 1e6, 1),
+                # bucket upper bound in us -> samples
+                'buckets': dict((str(1 << n), c) for n, c in enumerate(self.buckets) if c),
+                }
+
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.time()
+        self.packets = 0        # packets processed
+        self.rejected = 0       # packets that failed validation
+        self.reasons = dict((r, 0) for r in REASONS)
+        self.missing = 0        # mapped fields sent as a placeholder (--)
+        self.truncated = 0      # packets too large for the journal to keep whole
+        self.parse = Histogram()
+        self.convert = Histogram()
+        self.publish = Histogram()
+        self.totals = dict((name, Histogram()) for name in TIMINGS)
+        self.queue = None       # receiver.PacketQueue once the engine runs
+
+    def received(self):
+        # Everything read from the sockets, processed or not.
+        if self.queue is None:
+            return self.packets
+        return self.queue.received
+
+    def skipped(self):
+        # Packets read but thrown away because the queue was full.
+        if self.queue is None:
+            return 0
+        return self.queue.dropped + self.queue.conflated
+
+    def reject(self, reason):
+        self.rejected += 1
+        self.reasons[reason] += 1
+
+    def roll(self):
+        # End of a publish interval, start the timings afresh.
+        for name in TIMINGS:
+            h = getattr(self, name)
+            self.totals[name].merge(h)
+            h.reset()
+
+    def lifetime(self, name):
+        h = Histogram()
+        h.merge(self.totals[name])
+        h.merge(getattr(self, name))
+        return h
+
+    def queue_depth(self):
+        return len(self.queue) if self.queue is not None else 0
+
+    def snapshot(self):
+        q = self.queue
+        return {
+                'time': time.time(),
+                'uptime': round(time.time() - self.started, 1),
+                'packets_received': self.received(),
+                'packets_processed': self.packets,
+                'packets_skipped': self.skipped(),
+                'packets_rejected': self.rejected,
+                'rejected': dict(self.reasons),
+                'fields_missing': self.missing,
+                'journal_truncated': self.truncated,
+                'queue_depth': self.queue_depth(),
+                'queue_high_water': q.high_water if q is not None else 0,
+                'queue_pauses': q.blocked if q is not None else 0,
+                'parse': self.lifetime('parse').snapshot(),
+                'convert': self.lifetime('convert').snapshot(),
+                'publish': self.lifetime('publish').snapshot(),
+                }
+
+    def dump(self, path):
+        # Write the snapshot as JSON, replacing the file atomically so a
+        # reader never sees a partial file.
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
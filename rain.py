@@ -0,0 +1,139 @@
+# Rain accumulation
+#
+# Builds hourly, daily, weekly, monthly and yearly rain totals (plus
+# yesterday's total) from either a rain counter (a running total, like
+# Weather Display's daily rain, that may reset) or the rain rate.
+#
+# Period boundaries are calculated in local time when a period starts and
+# kept as timestamps, so adding a sample is one comparison against the
+# nearest boundary plus the additions. Days, weeks, months and years start
+# at local midnight (weeks on Monday) using mktime(), which takes care of
+# daylight saving time; hours start at the top of the local hour.
+
+import time
+
+PERIODS = ('hour', 'day', 'week', 'month', 'year')
+
+# Longest gap, in seconds, the rain rate is integrated over. Anything
+# longer is treated as missing data rather than rain.
+MAX_GAP = 300
+
+
+def next_boundary(period, now):
+    """ Time stamp of the start of the period following the one at now. """
+    t = time.localtime(now)
+    if period == 'hour':
+        return int(now) - (t.tm_min * 60 + t.tm_sec) + 3600
+    if period == 'day':
+        start = (t.tm_year, t.tm_mon, t.tm_mday + 1)
+    elif period == 'week':
+        start = (t.tm_year, t.tm_mon, t.tm_mday + 7 - t.tm_wday)
+    elif period == 'month':
+        start = (t.tm_year, t.tm_mon + 1, 1)
+    else:
+        start = (t.tm_year + 1, 1, 1)
+    # mktime normalizes day 32, month 13, etc. and works out whether
+    # daylight saving time is in effect at the new boundary.
+    return time.mktime(start + (0, 0, 0, 0, 0, -1))
+
+
+class RainAccumulator(object):
+    def __init__(self, now=None):
+        if now is None:
+            now = time.time()
+        self.totals = dict((p, 0.0) for p in PERIODS)
+        self.yesterday = 0.0
+        self.boundaries = dict((p, next_boundary(p, now)) for p in PERIODS)
+        self.next = min(self.boundaries.values())
+        self.last_counter = None
+        self.last_time = None
+        self.dirty = False
+
+    def roll(self, now):
+        # One or more periods have ended.
+        for p in PERIODS:
+            if now < self.boundaries[p]:
+                continue
+            if p == 'day':
+                # Yesterday is only the day that just ended if we haven't
+                # skipped over a whole day.
+                following = next_boundary('day', self.boundaries['day'])
+                self.yesterday = self.totals['day'] if now < following else 0.0
+            self.totals[p] = 0.0
+            self.boundaries[p] = next_boundary(p, now)
+        self.next = min(self.boundaries.values())
+        self.dirty = True
+
+    def add(self, amount, now):
+        if now >= self.next:
+            self.roll(now)
+        if amount > 0:
+            for p in PERIODS:
+                self.totals[p] += amount
+            self.dirty = True
+
+    def push_counter(self, value, now=None):
+        # value is a running total; rain is the increase since the last
+        # sample. A decrease means the counter was reset and everything
+        # since the reset is new rain.
+        if now is None:
+            now = time.time()
+        last = self.last_counter
+        self.last_counter = value
+        if value != last:
+            self.dirty = True
+        if last is None:
+            self.add(0.0, now)
+            return
+        self.add(value - last if value >= last else value, now)
+
+    def push_rate(self, rate, now=None):
+        # rate is per minute.
+        if now is None:
+            now = time.time()
+        last = self.last_time
+        self.last_time = now
+        if last is None or now - last > MAX_GAP or now <= last:
+            self.add(0.0, now)
+            return
+        self.add(rate * (now - last) / 60.0, now)
+
+    def total(self, period, now=None):
+        if now is None:
+            now = time.time()
+        if now >= self.next:
+            self.roll(now)
+        if period == 'yesterday':
+            return self.yesterday
+        return self.totals[period]
+
+    def get_state(self):
+        return {
+                'totals': self.totals,
+                'yesterday': self.yesterday,
+                'boundaries': self.boundaries,
+                'counter': self.last_counter,
+                }
+
+    def set_state(self, state):
+        # Totals for periods that ended while we weren't running are
+        # cleared by the roll.
+        self.totals = dict((p, float(state['totals'][p])) for p in PERIODS)
+        self.yesterday = float(state['yesterday'])
+        self.boundaries = dict((p, float(state['boundaries'][p])) for p in PERIODS)
+        self.next = min(self.boundaries.values())
+        self.last_counter = state['counter']
+        self.roll(time.time())
+
+
+class Total(object):
+    """ Window style view of one accumulated total, for the publish plan. """
+    def __init__(self, accumulator, period):
+        self.accumulator = accumulator
+        self.period = period
+
+    def value(self):
+        return round(self.accumulator.total(self.period), 3)
+
+    def reset(self):
+        pass
@@ -0,0 +1,437 @@
+# asyncio based datagram ingestion
+#
+# Receiving and processing are separate stages. All of the packet sources
+# are read by a single asyncio event loop, on its own thread, that does
+# nothing but copy each datagram into a bounded queue. A publisher thread
+# drains the queue, runs the packet handlers and the periodic publishing,
+# so a slow Polyglot connection can't keep the sockets from being read.
+# Stopping the engine cancels the loop immediately, there's no waiting for
+# the next packet to arrive.
+#
+# Each source's socket is registered directly with the loop's selector and
+# datagrams are received into a preallocated buffer with recvfrom_into().
+# Handlers get the queued copy, as bytes, and the sender's address.
+#
+# When the queue is full the configured policy decides what happens:
+#   drop-oldest - discard the oldest queued packet to make room
+#   conflate    - discard the queued packets from the same source, only
+#                 the newest packet from a source is worth processing
+#   block       - stop reading the sockets until the queue has drained to
+#                 half full, leaving packets in the kernel's socket buffer
+# Every discarded packet, and every pause, is counted.
+#
+# Stream servers (the local HTTP API) can also be added; their
+# connections are handled by coroutines on the same loop. So can watched
+# files (see filewatch.py): their contents are queued like a datagram when
+# the file changes. Remote files (see webpoll.py) are polled on the
+# loop's executor threads so a slow web server never holds up the loop.
+
+import asyncio
+import collections
+import random
+import socket
+import struct
+import threading
+import time
+
+# Large enough for any UDP datagram, so nothing is ever truncated.
+BUFFER_SIZE = 65536
+
+# Maximum datagrams read per wakeup before giving other tasks a turn.
+BURST = 64
+
+POLICIES = ('drop-oldest', 'conflate', 'block')
+
+
+def multicast_socket(group, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((group, port))
+    mreq = struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    s.setblocking(False)
+    return s
+
+
+def listen_socket(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, port))
+    s.listen(16)
+    s.setblocking(False)
+    return s
+
+
+class Input(object):
+    """
+    Anything packets come from: its handler and the time the last packet
+    was received, which the stall watchdog checks.
+    """
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+        self.last_packet = time.time()
+        self.stalled = False
+
+
+class Source(Input):
+    """ A UDP socket. """
+    def __init__(self, name, sock, handler):
+        super(Source, self).__init__(name, handler)
+        self.sock = sock
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.registered = False
+
+
+class PacketQueue(object):
+    """ Bounded, thread safe queue of (source, data, addr) entries. """
+    def __init__(self, size=256, policy='drop-oldest'):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy: ' + str(policy))
+        self.size = max(1, size)
+        self.policy = policy
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.paused = False
+        self.on_space = None    # called when a paused queue has room again
+        self.dropped = 0        # packets discarded to make room
+        self.conflated = 0      # packets replaced by a newer one
+        self.blocked = 0        # times reading was paused
+        self.received = 0       # packets put on the queue
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        return len(self.items) >= self.size
+
+    def pause(self):
+        with self.cond:
+            if not self.paused:
+                self.paused = True
+                self.blocked += 1
+
+    def put(self, item):
+        with self.cond:
+            self.received += 1
+            if len(self.items) >= self.size and self.policy == 'conflate':
+                source = item[0]
+                kept = collections.deque(i for i in self.items if i[0] is not source)
+                self.conflated += len(self.items) - len(kept)
+                self.items = kept
+            if len(self.items) >= self.size:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.cond.notify()
+
+    def get(self, timeout):
+        resume = False
+        with self.cond:
+            if not self.items and not self.closed:
+                self.cond.wait(timeout)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            if self.paused and len(self.items) <= self.size // 2:
+                self.paused = False
+                resume = True
+        if resume and self.on_space is not None:
+            self.on_space()
+        return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Engine(object):
+    def __init__(self, logger, stall_timeout=120, on_stall=None, on_resume=None,
+            queue_size=256, queue_policy='drop-oldest'):
+        self.logger = logger
+        self.stall_timeout = stall_timeout
+        self.on_stall = on_stall
+        self.on_resume = on_resume
+        self.sources = []
+        self.servers = []   # (listening socket, connection coroutine)
+        self.files = []     # filewatch.FileSource
+        self.remote = []    # webpoll.WebSource
+        self.periodic = []
+        self.queue = PacketQueue(queue_size, queue_policy)
+        self.queue.on_space = self._space
+        self.stopping = False
+        self.loop = None
+        self.task = None
+        self.thread = None
+        self.worker = None
+
+    def add_multicast(self, group, port, handler):
+        name = '%s:%d' % (group, port)
+        self.sources.append(Source(name, multicast_socket(group, port), handler))
+
+    def add_server(self, host, port, handler):
+        # handler(reader, writer) is a coroutine run on the loop for each
+        # connection, it must not block.
+        self.servers.append((listen_socket(host, port), handler))
+
+    def add_file(self, source):
+        self.files.append(source)
+
+    def add_remote(self, source):
+        self.remote.append(source)
+
+    def inputs(self):
+        # Everything data comes from, for the stall watchdog.
+        return self.sources + self.files + self.remote
+
+    def every(self, interval, callback):
+        # interval is a function returning the number of seconds to wait so
+        # that configuration changes take effect on the next cycle. These
+        # run on the publisher thread, between packets.
+        self.periodic.append((interval, callback))
+
+    def start(self, publisher=True):
+        # The publisher can be started later, packets received until then
+        # wait in the queue.
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        if publisher:
+            self.start_publisher()
+
+    def start_publisher(self):
+        if self.worker is None and not self.stopping:
+            self.worker = threading.Thread(target=self.work)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def stop(self):
+        self.stopping = True
+        self.queue.close()
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._cancel)
+
+    def join(self, timeout=None):
+        # Wait for both stages to finish after stop().
+        for thread in (self.thread, self.worker):
+            if thread is not None:
+                thread.join(timeout)
+
+    def _cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def run(self):
+        # The loop is built by hand rather than with asyncio.run() since
+        # Raspbian Stretch has Python 3.5.
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.task = loop.create_task(self.main())
+        self.loop = loop
+        if self.stopping:
+            self.task.cancel()
+        try:
+            loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.logger.error('Receive loop failed: {}'.format(e), exc_info=True)
+        finally:
+            # Cancel whatever is left, like open API connections.
+            all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+            pending = [t for t in all_tasks(loop) if not t.done()]
+            for t in pending:
+                t.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+        self.logger.info('Receive loop stopped.')
+
+    async def main(self):
+
+        tasks = []
+        servers = []
+        try:
+            for source in self.sources:
+                self.logger.info('Listening for packets on ' + source.name)
+                self.register(source)
+            for (sock, handler) in self.servers:
+                servers.append(await asyncio.start_server(handler, sock=sock))
+            for source in self.files:
+                # The file is checked every interval even when it's
+                # watched, inotify doesn't see writes to a network share
+                # made by another machine.
+                if source.fileno() is not None:
+                    self.logger.info('Watching ' + source.name)
+                    self.loop.add_reader(source.fileno(), self.file_changed, source)
+                self.logger.info('Checking %s every %s seconds' % (source.name, source.interval))
+                tasks.append(asyncio.ensure_future(self.poll_file(source)))
+                # Pick up what's there now.
+                self.read_file(source)
+            for source in self.remote:
+                self.logger.info('Polling %s every %s seconds' % (source.name, source.interval))
+                tasks.append(asyncio.ensure_future(self.poll_remote(source)))
+            tasks.append(asyncio.ensure_future(self.watchdog()))
+
+            # Runs until cancelled by stop()
+            await asyncio.gather(self.loop.create_future(), *tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+            for server in servers:
+                server.close()
+            for source in self.sources:
+                self.unregister(source)
+                source.sock.close()
+            for source in self.files:
+                if source.fileno() is not None:
+                    self.loop.remove_reader(source.fileno())
+                source.close()
+
+    def register(self, source):
+        if not source.registered:
+            self.loop.add_reader(source.sock.fileno(), self.readable, source)
+            source.registered = True
+
+    def unregister(self, source):
+        if source.registered:
+            self.loop.remove_reader(source.sock.fileno())
+            source.registered = False
+
+    def _space(self):
+        # Called on the publisher thread once a paused queue has drained.
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.resume)
+
+    def resume(self):
+        for source in self.sources:
+            self.register(source)
+
+    def readable(self, source):
+        recv = source.sock.recvfrom_into
+        queue = self.queue
+        for n in range(BURST):
+            if queue.policy == 'block' and queue.full():
+                # Stop reading until the publisher catches up, the packets
+                # wait in the kernel's socket buffer.
+                queue.pause()
+                for s in self.sources:
+                    self.unregister(s)
+                return
+            try:
+                (nbytes, addr) = recv(source.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.logger.error('Receive from %s failed: %s' % (source.name, e))
+                return
+            source.last_packet = time.time()
+            queue.put((source, source.view[:nbytes].tobytes(), addr))
+
+    def file_changed(self, source):
+        if source.events():
+            self.read_file(source)
+
+    async def poll_file(self, source):
+        while True:
+            await asyncio.sleep(source.interval)
+            self.read_file(source)
+
+    def read_file(self, source):
+        try:
+            data = source.read()
+        except OSError as e:
+            self.logger.error('Read of %s failed: %s' % (source.name, e))
+            return
+        self.queue_data(source, data)
+
+    async def poll_remote(self, source):
+        # Start at a random point in the interval so sources don't line up.
+        await asyncio.sleep(random.uniform(0, min(source.interval, 5)))
+        failing = False
+        while True:
+            try:
+                data = await self.loop.run_in_executor(None, source.read)
+                if failing:
+                    failing = False
+                    self.logger.info('Poll of %s is working again' % source.name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Only the first failure in a row is a warning, the stall
+                # watchdog reports a server that stays down.
+                (self.logger.debug if failing else self.logger.warning)(
+                        'Poll of %s failed: %s' % (source.name, e))
+                failing = True
+                data = None
+            self.queue_data(source, data)
+            await asyncio.sleep(source.delay())
+
+    def queue_data(self, source, data):
+        if data is None:
+            return
+        source.last_packet = time.time()
+        self.queue.put((source, data, (source.name, 0)))
+
+    def work(self):
+        # Publisher stage: handle queued packets and run the periodic
+        # callbacks when they're due.
+        now = time.time()
+        due = [now + interval() for (interval, callback) in self.periodic]
+        queue = self.queue
+        lost = 0
+        while not self.stopping:
+            now = time.time()
+            for i, (interval, callback) in enumerate(self.periodic):
+                if now < due[i]:
+                    continue
+                due[i] = now + interval()
+                try:
+                    callback(now)
+                except Exception as e:
+                    self.logger.error('Periodic task failed: {}'.format(e), exc_info=True)
+
+                # Report overflows at most once per cycle.
+                if queue.dropped + queue.conflated + queue.blocked != lost:
+                    lost = queue.dropped + queue.conflated + queue.blocked
+                    self.logger.warning('Packet queue overflow: %d dropped, %d conflated, %d pauses' %
+                            (queue.dropped, queue.conflated, queue.blocked))
+
+            timeout = (min(due) - time.time()) if due else 1.0
+            item = queue.get(max(timeout, 0))
+            if item is None:
+                continue
+            (source, data, addr) = item
+            try:
+                source.handler(data, addr)
+            except Exception as e:
+                self.logger.error('Packet from %s failed: %s' % (source.name, e))
+        self.logger.info('Publisher stopped.')
+
+    async def watchdog(self):
+        # Check for sources that have stopped sending data.
+        while True:
+            await asyncio.sleep(min(self.stall_timeout, 10) or 10)
+            if not self.stall_timeout:
+                continue
+            now = time.time()
+            for source in self.inputs():
+                quiet = now - source.last_packet
+                if quiet >= self.stall_timeout and not source.stalled:
+                    source.stalled = True
+                    self.logger.warning('No data from %s for %d seconds' %
+                            (source.name, quiet))
+                    if self.on_stall:
+                        self.on_stall(source)
+                elif quiet < self.stall_timeout and source.stalled:
+                    source.stalled = False
+                    self.logger.info('Data from %s has resumed' % source.name)
+                    if self.on_resume:
+                        self.on_resume(source)
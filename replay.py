@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Record and replay Weather Display packets.
+
+Records the raw datagrams multicast by Weather Display, with the time each
+was received, so they can be fed back through the node server's packet
+pipeline (parse -> sample -> publish) of the primary station without a
+live Weather Display or a Polyglot connection. polyinterface is replaced
+by a local stand-in that just counts the messages that would have been
+sent.
+
+    replay.py record packets.wdr [--group 231.31.31.31] [--port 1333] [--count N]
+    replay.py generate packets.wdr [--count 3600]
+    replay.py replay packets.wdr [--speed 1|N|max] [--param key=value ...]
+    replay.py serve packets.wdr [--port 8000] [--speed 1|N]
+
+serve is a stand-in for the web server Weather Display uploads
+clientraw.txt to: the recording is served as /clientraw.txt (plus a
+synthetic /clientrawextra.txt), one packet after another at the recorded
+rate, with ETag and Last-Modified so ClientrawURL polling can be tried
+without a live station.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import types
+
+MAGIC = b'WDR1'
+RECORD = struct.Struct('<dI')  # receive time, payload length
+
+
+def write_record(f, ts, data):
+    f.write(RECORD.pack(ts, len(data)))
+    f.write(data)
+
+
+def read_records(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a packet recording' % path)
+        while True:
+            hdr = f.read(RECORD.size)
+            if len(hdr) < RECORD.size:
+                return
+            (ts, length) = RECORD.unpack(hdr)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield (ts, data)
+
+
+def record(args):
+    import receiver
+    s = receiver.multicast_socket(args.group, args.port)
+    s.setblocking(True)
+    count = 0
+    with open(args.file, 'wb') as f:
+        f.write(MAGIC)
+        try:
+            while args.count == 0 or count < args.count:
+                (data, addr) = s.recvfrom(receiver.BUFFER_SIZE)
+                write_record(f, time.time(), data)
+                count += 1
+        except KeyboardInterrupt:
+            pass
+    s.close()
+    print('Recorded %d packets to %s' % (count, args.file))
+
+
+def synthetic_packet(n):
+    # Something shaped like clientraw.txt: '12345' header, ~180 numeric
+    # fields and the trailing !!version!! marker.
+    fields = ['12345']
+    for i in range(1, 178):
+        fields.append('%.1f' % (random.uniform(0, 30) + (i % 7)))
+    fields[4] = '%.1f' % (15 + 5 * ((n % 3600) / 3600.0))  # temperature
+    fields[5] = '%d' % random.randint(40, 90)             # humidity
+    fields[6] = '%.1f' % (1010 + (n % 10800) / 3600.0)     # pressure
+    fields.append('!!C10.37S136!!')
+    return ' '.join(fields).encode('utf-8')
+
+
+def generate(args):
+    ts = time.time()
+    with open(args.file, 'wb') as f:
+        f.write(MAGIC)
+        for n in range(args.count):
+            write_record(f, ts + n, synthetic_packet(n))
+    print('Generated %d packets in %s' % (args.count, args.file))
+
+
+def serve(args):
+    from email.utils import formatdate
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    records = list(read_records(args.file))
+    if not records:
+        print('No packets in %s' % args.file)
+        return
+    start = time.time()
+    speed = float(args.speed)
+    first = records[0][0]
+    extra = ' '.join(['12345'] + ['%.1f' % (i * 0.5) for i in range(1, 60)] +
+            ['!!C10.37S136!!']).encode('utf-8')
+    counts = {'connections': 0, 'requests': 0, 'not modified': 0}
+
+    def current():
+        # Index of the packet that's "in" clientraw.txt now.
+        elapsed = (time.time() - start) * speed
+        n = 0
+        while n + 1 < len(records) and records[n + 1][0] - first <= elapsed:
+            n += 1
+        return n
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            counts['connections'] += 1
+
+        def do_GET(self):
+            counts['requests'] += 1
+            if self.path == '/clientraw.txt':
+                n = current()
+                body = records[n][1]
+                etag = '"%d"' % n
+                modified = start + (records[n][0] - first) / speed
+            elif self.path == '/clientrawextra.txt':
+                body = extra
+                etag = '"extra"'
+                modified = start
+            else:
+                self.send_error(404)
+                return
+            if self.headers.get('If-None-Match') == etag:
+                counts['not modified'] += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(modified, usegmt=True))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), Handler)
+    print('Serving %d packets from %s on http://127.0.0.1:%d/clientraw.txt' %
+            (len(records), args.file, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(', '.join('%d %s' % (v, k) for k, v in counts.items()))
+
+
+def stub_polyinterface():
+    """ Minimal stand-in for the parts of polyinterface the node uses. """
+    pi = types.ModuleType('polyinterface')
+    pi.LOGGER = logging.getLogger('wdpoly')
+
+    class Interface(object):
+        def __init__(self, name):
+            self.messages = 0
+            self.config = {'customParams': {}}
+
+        def send(self, message):
+            self.messages += 1
+
+        def installprofile(self):
+            pass
+
+        def onConfig(self, callback):
+            pass
+
+        def start(self):
+            pass
+
+    class Node(object):
+        drivers = []
+
+        def __init__(self, controller, primary, address, name):
+            self.controller = controller
+            self.parent = controller
+            self.poly = controller.poly
+            self.primary = primary
+            self.address = address
+            self.name = name
+            self.drivers = [dict(d) for d in self.drivers]
+
+        def setDriver(self, driver, value, report=True, force=False, uom=None):
+            for d in self.drivers:
+                if d['driver'] == driver:
+                    d['value'] = value
+                    if report:
+                        self.reportDriver(d, report, force)
+                    break
+
+        def reportDriver(self, driver, report, force):
+            self.poly.send({'status': driver})
+
+        def reportDrivers(self):
+            for d in self.drivers:
+                self.reportDriver(d, True, True)
+
+        def updateDrivers(self, drivers):
+            pass
+
+    class Controller(Node):
+        def __init__(self, poly):
+            self.poly = poly
+            self.controller = self
+            self.nodes = {}
+            self.polyConfig = poly.config
+            self.drivers = [dict(d) for d in self.drivers]
+
+        def addNode(self, node, update=False):
+            self.nodes[node.address] = node
+            return node
+
+        def delNode(self, address):
+            self.nodes.pop(address, None)
+
+        def addCustomParam(self, params):
+            for key in params:
+                self.polyConfig['customParams'].setdefault(key, params[key])
+
+        def addNotice(self, data, key=None):
+            pass
+
+        def removeNotice(self, key):
+            pass
+
+        def removeNoticesAll(self):
+            pass
+
+    pi.Interface = Interface
+    pi.Node = Node
+    pi.Controller = Controller
+    return pi
+
+
+class Stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+
+    def report(self):
+        if not self.times:
+            return '%-8s        no samples' % self.name
+        t = sorted(self.times)
+        n = len(t)
+        return '%-8s %8d  mean %8.1f  p50 %8.1f  p99 %8.1f  max %8.1f us' % (
+                self.name, n, 1e6 * sum(t) / n, 1e6 * t[n // 2],
+                1e6 * t[min(n - 1, int(n * 0.99))], 1e6 * t[-1])
+
+
+def replay(args):
+    src = os.path.dirname(os.path.abspath(__file__))
+    records = list(read_records(args.file))
+    if not records:
+        print('No packets in %s' % args.file)
+        return
+
+    # Run in a scratch copy so the generated profile doesn't touch the
+    # real one.
+    work = tempfile.mkdtemp(prefix='wdreplay')
+    shutil.copytree(os.path.join(src, 'profile'), os.path.join(work, 'profile'))
+    shutil.copy(os.path.join(src, 'server.json'), work)
+    cwd = os.getcwd()
+    os.chdir(work)
+
+    sys.modules['polyinterface'] = stub_polyinterface()
+    sys.path.insert(0, src)
+    import wdpoly
+
+    try:
+        poly = sys.modules['polyinterface'].Interface('WeatherDisplay')
+        for p in args.param:
+            (key, value) = p.split('=', 1)
+            poly.config['customParams'][key] = value
+        control = wdpoly.Controller(poly)
+        control.check_params()
+        control.map_nodes(poly.config)
+        control.discover()
+        station = control.stations['']
+
+        parse = Stage('parse')
+        sample = Stage('sample')
+        publish = Stage('publish')
+        clock = time.perf_counter
+
+        speed = 0 if args.speed == 'max' else float(args.speed)
+        first = records[0][0]
+        next_publish = first + control.publish_interval
+        start = clock()
+        for (ts, data) in records:
+            if speed:
+                delay = (ts - first) / speed - (clock() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            t0 = clock()
+            fields = station.parse(data)
+            reason = station.validate(fields)
+            t1 = clock()
+            if reason is None:
+                station.sample(fields)
+            t2 = clock()
+            parse.times.append(t1 - t0)
+            sample.times.append(t2 - t1)
+
+            if ts >= next_publish:
+                next_publish = ts + control.publish_interval
+                t0 = clock()
+                control.publish(ts)
+                publish.times.append(clock() - t0)
+        elapsed = clock() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+
+    busy = sum(parse.times) + sum(sample.times) + sum(publish.times)
+    print('%d packets, %d fields mapped, %d messages sent' %
+            (len(records), len(station.plan.entries), poly.messages))
+    print('elapsed %.3f s, %.0f packets/s (%.0f packets/s of pipeline time)' %
+            (elapsed, len(records) / elapsed, len(records) / busy if busy else 0))
+    for stage in (parse, sample, publish):
+        print(stage.report())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record and replay Weather Display packets.')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('record', help='record packets from Weather Display')
+    p.add_argument('file')
+    p.add_argument('--group', default='231.31.31.31')
+    p.add_argument('--port', type=int, default=1333)
+    p.add_argument('--count', type=int, default=0, help='stop after N packets (0 = until ^C)')
+    p.set_defaults(func=record)
+
+    p = sub.add_parser('generate', help='write a synthetic recording')
+    p.add_argument('file')
+    p.add_argument('--count', type=int, default=3600)
+    p.set_defaults(func=generate)
+
+    p = sub.add_parser('replay', help='replay a recording through the pipeline')
+    p.add_argument('file')
+    p.add_argument('--speed', default='max', help='1 for real time, N for N times faster, max for no delay')
+    p.add_argument('--param', action='append', default=[], help='custom parameter key=value')
+    p.set_defaults(func=replay)
+
+    p = sub.add_parser('serve', help='serve a recording as clientraw.txt over HTTP')
+    p.add_argument('file')
+    p.add_argument('--port', type=int, default=8000)
+    p.add_argument('--speed', default='1', help='1 for real time, N for N times faster')
+    p.set_defaults(func=serve)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
@@ -0,0 +1,93 @@
+# Persistent state
+#
+# Periodic snapshots of the in-memory rolling state (pressure trend
+# history, rain accumulators, last reported values, ...) so a restart
+# picks up where the last run left off instead of rebuilding trends and
+# totals from nothing.
+#
+# Anything with get_state(), set_state(state) and a dirty flag can be
+# registered under a unique key. Each object's state is JSON encoded only
+# when it has changed since the last snapshot and the file is only written
+# when something changed. The file is replaced atomically so a crash while
+# writing leaves the previous snapshot intact.
+
+import json
+import os
+import time
+
+VERSION = 1
+
+
+class Snapshot(object):
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.sources = {}   # key -> object
+        self.encoded = {}   # key -> JSON of the object's last saved state
+        self.loaded = {}    # key -> state read from the file, not yet claimed
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.error('Unable to read state from %s: %s' % (self.path, e))
+            return
+        if data.get('version') != VERSION:
+            self.logger.warning('Ignoring state file %s, wrong version' % self.path)
+            return
+        self.loaded = data.get('state', {})
+        self.logger.info('Loaded state saved %d seconds ago' %
+                (time.time() - data.get('time', 0)))
+
+    def register(self, key, obj):
+        old = self.sources.get(key)
+        self.sources[key] = obj
+        if old is not None and old is not obj:
+            # Replaced (rediscovered) object, carry the state over.
+            state = old.get_state()
+        elif key in self.loaded:
+            state = self.loaded.pop(key)
+        else:
+            return
+        try:
+            obj.set_state(state)
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            self.logger.error('Unable to restore state of %s: %s' % (key, e))
+
+    def keep(self, keys):
+        # Stop saving the objects not listed, their state is dropped from
+        # the next snapshot.
+        for key in set(self.sources) - set(keys):
+            del self.sources[key]
+
+    def save(self):
+        changed = False
+        for key, obj in self.sources.items():
+            if obj.dirty or key not in self.encoded:
+                obj.dirty = False
+                self.encoded[key] = json.dumps(obj.get_state(), separators=(',', ':'))
+                changed = True
+        for key in list(self.encoded):
+            if key not in self.sources:
+                del self.encoded[key]
+                changed = True
+        if not changed:
+            return False
+
+        # Unclaimed state is kept, the object may come back later.
+        parts = [json.dumps(k) + ':' + v for k, v in self.encoded.items()]
+        parts.extend(json.dumps(k) + ':' + json.dumps(v, separators=(',', ':'))
+                for k, v in self.loaded.items() if k not in self.encoded)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('{"version":%d,"time":%.3f,"state":{' % (VERSION, time.time()))
+            f.write(','.join(parts))
+            f.write('}}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return True
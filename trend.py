@@ -0,0 +1,167 @@
+# Pressure trend
+#
+# Keeps a time stamped history of pressure readings in a fixed size ring
+# buffer and maintains the sums for a least squares fit of pressure against
+# time. Adding a sample and reading the trend are both O(1) (the sums are
+# rebuilt from the buffer every capacity samples to keep rounding error
+# from accumulating, which is still O(1) amortized).
+
+from array import array
+import time
+
+FALLING = -1
+STEADY = 0
+RISING = 1
+
+
+class PressureTrend(object):
+    def __init__(self, window=10800, capacity=1080, threshold=1.6, min_span=900):
+        self.window = window        # seconds of history used for the fit
+        self.capacity = capacity
+        self.spacing = float(window) / capacity  # min seconds between samples
+        self.threshold = threshold  # change over the window that counts as rising/falling
+        self.min_span = min_span    # seconds of history needed for a trend
+        self.times = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.head = 0
+        self.count = 0
+        self.inserts = 0
+        self.t0 = None
+        self.sx = 0.0
+        self.sy = 0.0
+        self.sxx = 0.0
+        self.sxy = 0.0
+        self.dirty = False
+
+    def _oldest(self):
+        return (self.head - self.count) % self.capacity
+
+    def _remove_oldest(self):
+        i = self._oldest()
+        x = self.times[i] - self.t0
+        y = self.values[i]
+        self.sx -= x
+        self.sy -= y
+        self.sxx -= x * x
+        self.sxy -= x * y
+        self.count -= 1
+
+    def _rebase(self):
+        # Recompute the sums relative to the oldest sample.
+        self.inserts = 0
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+        if self.count == 0:
+            self.t0 = None
+            return
+        i = self._oldest()
+        self.t0 = self.times[i]
+        for n in range(self.count):
+            x = self.times[i] - self.t0
+            y = self.values[i]
+            self.sx += x
+            self.sy += y
+            self.sxx += x * x
+            self.sxy += x * y
+            i += 1
+            if i == self.capacity:
+                i = 0
+
+    def push(self, value, now=None):
+        if now is None:
+            now = time.time()
+        if self.count > 0:
+            last = self.times[(self.head - 1) % self.capacity]
+            if now - last < self.spacing:
+                return
+        else:
+            self.t0 = now
+
+        if self.count == self.capacity:
+            self._remove_oldest()
+
+        x = now - self.t0
+        self.times[self.head] = now
+        self.values[self.head] = value
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        self.count += 1
+        self.sx += x
+        self.sy += value
+        self.sxx += x * x
+        self.sxy += x * value
+        self.dirty = True
+
+        # Drop samples that have aged out of the window.
+        cutoff = now - self.window
+        while self.count > 1 and self.times[self._oldest()] < cutoff:
+            self._remove_oldest()
+
+        self.inserts += 1
+        if self.inserts >= self.capacity:
+            self._rebase()
+
+    def span(self):
+        if self.count < 2:
+            return 0
+        return self.times[(self.head - 1) % self.capacity] - self.times[self._oldest()]
+
+    def slope(self):
+        # Pressure change per second from the least squares fit.
+        n = self.count
+        if n < 2:
+            return None
+        d = n * self.sxx - self.sx * self.sx
+        if d <= 0:
+            return None
+        return (n * self.sxy - self.sx * self.sy) / d
+
+    def change(self):
+        # Pressure change over the full window (i.e. the 3 hour trend).
+        if self.span() < self.min_span:
+            return None
+        s = self.slope()
+        if s is None:
+            return None
+        return s * self.window
+
+    def classify(self):
+        c = self.change()
+        if c is None:
+            return STEADY
+        if c >= self.threshold:
+            return RISING
+        if c <= -self.threshold:
+            return FALLING
+        return STEADY
+
+    # Window style interface so the trend can be published like any other
+    # mapped field.
+    def value(self):
+        c = self.change()
+        if c is None:
+            return None
+        return round(c, 3)
+
+    def reset(self):
+        pass
+
+    # Saved state is the history, oldest first.
+    def get_state(self):
+        times = []
+        values = []
+        i = self._oldest()
+        for n in range(self.count):
+            times.append(self.times[i])
+            values.append(self.values[i])
+            i = (i + 1) % self.capacity
+        return {'times': times, 'values': values}
+
+    def set_state(self, state):
+        self.head = 0
+        self.count = 0
+        self.inserts = 0
+        self.t0 = None
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+        for (t, v) in zip(state['times'], state['values']):
+            self.push(v, t)
@@ -24,3 +24,69 @@ UOM = {
         'I_KM': 83,
         'I_MILE': 116,
         }
+
+UNIT_SYSTEMS = ('metric', 'us', 'uk')
+
+# Editor used for each kind of value in each unit system. The U.K. uses
+# Celsius, millibars and millimeters of rain but miles and miles per hour.
+EDITORS = {
+        'temperature' : {'metric': 'I_TEMP_C', 'us': 'I_TEMP_F', 'uk': 'I_TEMP_C'},
+        'pressure' : {'metric': 'I_MB', 'us': 'I_INHG', 'uk': 'I_MB'},
+        'trend' : {'metric': 'I_TREND_MB', 'us': 'I_TREND_INHG', 'uk': 'I_TREND_MB'},
+        'speed' : {'metric': 'I_KPH', 'us': 'I_MPH', 'uk': 'I_MPH'},
+        'rate' : {'metric': 'I_MMHR', 'us': 'I_INHR', 'uk': 'I_MMHR'},
+        'depth' : {'metric': 'I_MM', 'us': 'I_INCHES', 'uk': 'I_MM'},
+        'distance' : {'metric': 'I_KM', 'us': 'I_MILE', 'uk': 'I_MILE'},
+        }
+
+# Conversion from the units Weather Display sends (Celsius, millibars,
+# knots, millimeters, millimeters per minute and kilometers) to the units
+# of each editor, as (scale, offset, decimal places). Decimal places of
+# None means no rounding, 0 means an integer.
+CONVERSIONS = {
+        'I_TEMP_C': (1.0, 0.0, 1),
+        'I_TEMP_F': (1.8, 32.0, 1),
+        'I_HUMIDITY': (1.0, 0.0, 0),
+        'I_MB': (1.0, 0.0, None),
+        'I_INHG': (0.02952998751, 0.0, 3),
+        'I_TREND_MB': (1.0, 0.0, None),
+        'I_TREND_INHG': (0.02952998751, 0.0, 3),
+        'I_KPH': (1.852, 0.0, 2),
+        'I_MPH': (1.15077945, 0.0, 2),
+        'I_DEGREE': (1.0, 0.0, None),
+        'I_MMHR': (60.0, 0.0, 3),
+        'I_INHR': (2.362, 0.0, 3),
+        'I_MM': (1.0, 0.0, None),
+        'I_INCHES': (0.03937, 0.0, 2),
+        'I_UV': (1.0, 0.0, None),
+        'I_LUX': (1.0, 0.0, None),
+        'I_RADIATION': (1.0, 0.0, None),
+        'I_STRIKES': (1.0, 0.0, 0),
+        'I_KM': (1.0, 0.0, 0),
+        'I_MILE': (1 / 1.609344, 0.0, 1),
+        }
+
+
+def editor(kind, units):
+    """ Editor ID for a kind of value (see EDITORS) in a unit system. """
+    editors = EDITORS[kind]
+    return editors.get(units, editors['metric'])
+
+
+def converter(editor_id):
+    """
+    Function converting a Weather Display value to the units of the
+    editor. Resolved once, when the fields are mapped.
+    """
+    (scale, offset, digits) = CONVERSIONS[editor_id]
+    if digits == 0:
+        if scale == 1.0 and offset == 0.0:
+            return lambda v: int(round(v))
+        return lambda v: int(round(v * scale + offset))
+    if digits is None:
+        if scale == 1.0 and offset == 0.0:
+            return float
+        return lambda v: v * scale + offset
+    if scale == 1.0 and offset == 0.0:
+        return lambda v: round(v, digits)
+    return lambda v: round(v * scale + offset, digits)
@@ -5,16 +5,23 @@ Copyright (c) 2018 Robert Paauwe
 """
 import polyinterface
 import sys
+import os
 import time
-import datetime
-import urllib3
-import json
-import socket
-import math
 import threading
-import struct
+import collections
+import math
+import re
 import write_profile
 import uom
+import aggregate
+import receiver
+import trend
+import journal
+import derived
+import metrics
+import rain
+import state
+import extremes
 
 LOGGER = polyinterface.LOGGER
 
@@ -27,57 +34,130 @@ class Controller(polyinterface.Controller):
         self.udp_port = 1333
         self.mcast_ip = "231.31.31.31"
         self.units = ""
-        self.temperature_list = {}
-        self.humidity_list = {}
-        self.pressure_list = {}
-        self.wind_list = {}
-        self.rain_list = {}
-        self.light_list = {}
-        self.lightning_list = {}
-        self.temperature_map = []
-        self.humidity_map = []
-        self.pressure_map = []
-        self.wind_map = []
-        self.rain_map = []
-        self.light_map = []
-        self.lightning_map = []
+        self.heartbeat = 600
+        self.publish_interval = 30
+        self.stall_timeout = 120
+        self.queue_size = 256
+        self.queue_policy = 'drop-oldest'
+        self.elevation = 0
+        self.engine = None
+        self.journal_dir = ''
+        self.metrics = metrics.Metrics()
+        self.metrics_file = ''
+        self.snapshot = None
+        self.history = None
+        self.api_address = '127.0.0.1'
+        self.api_port = 0
+        self.cache = None
+        self.state_file = 'state.json'
+        self.state_interval = 300
+        self.stations = {}  # station name -> Station, '' is the primary
         self.myConfig = {}
+        self.config_timer = None
+        self.config_lock = threading.Lock()
 
         self.poly.onConfig(self.process_config)
 
     def process_config(self, config):
-        # this seems to get called twice for every change, why?
-        # What does config represent?
+        # this seems to get called twice for every change, and an edit in
+        # the UI can be several changes in a row. Changes are applied once
+        # things have been quiet for CONFIG_DELAY seconds.
         LOGGER.info("Configuration Change...")
         if 'customParams' in config:
-            if config['customParams'] != self.myConfig:
-                LOGGER.info("Found difference with saved configuration.")
-                self.removeNoticesAll()
-                self.set_configuration(config)
-                self.map_nodes(config)
-                self.discover()
-                if config['customParams']['IPAddress'] != self.myConfig['IPAddress']:
-                    self.addNotice("Restart node server for IP address change to take effect")
-                if config['customParams']['UDPPort'] != self.myConfig['UDPPort']:
-                    self.addNotice("Restart node server for UDP Port change to take effect")
-                self.myConfig = config['customParams']
+            with self.config_lock:
+                if self.config_timer is not None:
+                    self.config_timer.cancel()
+                self.config_timer = threading.Timer(self.CONFIG_DELAY,
+                        self.apply_config, args=(config,))
+                self.config_timer.daemon = True
+                self.config_timer.start()
+
+    def apply_config(self, config):
+        with self.config_lock:
+            self.config_timer = None
+            if config['customParams'] == self.myConfig:
+                return
+            LOGGER.info("Found difference with saved configuration.")
+            self.removeNoticesAll()
+            self.set_configuration(config)
+            self.map_nodes(config)
+            self.discover()
+            self.remove_old_nodes()
+            if config['customParams'].get('IPAddress') != self.myConfig.get('IPAddress'):
+                self.addNotice("Restart node server for IP address change to take effect")
+            if config['customParams'].get('UDPPort') != self.myConfig.get('UDPPort'):
+                self.addNotice("Restart node server for UDP Port change to take effect")
+            if config['customParams'].get('Stations', '') != self.myConfig.get('Stations', ''):
+                self.addNotice("Restart node server for station list change to take effect")
+            changed = set(config['customParams'].items()) ^ set(self.myConfig.items())
+            if any(k.endswith(('ClientrawFile', 'ClientrawURL', 'ClientrawExtra'))
+                    for (k, v) in changed):
+                self.addNotice("Restart node server for clientraw source change to take effect")
+            if config['customParams'].get('APIPort', '') != self.myConfig.get('APIPort', ''):
+                self.addNotice("Restart node server for API port change to take effect")
+            self.myConfig = dict(config['customParams'])
 
     def start(self):
+        # Get the sockets open first so no packets are missed, they wait
+        # in the packet queue while the rest of the startup is done in the
+        # background.
         LOGGER.info('Starting WeatherDisplay Node Server')
+        timing = StartupTimer()
         self.check_params()
-        LOGGER.info('Calling discover')
-        self.discover()
-
-        LOGGER.info('starting thread for UDP data')
-        self.udp = threading.Thread(target = self.udp_data)
-        self.udp.daemon = True;
-        self.udp.start()
-
-        #for node in self.nodes:
-        #       LOGGER.info (self.nodes[node].name + ' is at index ' + node)
-        LOGGER.info('WeatherDisplay Node Server Started.')
-
-        self.remove_old_nodes()
+        timing.lap('config')
+
+        # All the stations are served by the same event loop.
+        LOGGER.info('starting receive loop for UDP data')
+        self.engine = receiver.Engine(LOGGER, self.stall_timeout,
+                self.stream_stalled, self.stream_resumed,
+                self.queue_size, self.queue_policy)
+        self.metrics.queue = self.engine.queue
+        for station in self.stations.values():
+            if station.clientraw_url != '':
+                import webpoll
+                self.engine.add_remote(webpoll.WebSource(station.clientraw_url,
+                        station.udp_data, station.url_interval, station.clientraw_extra))
+            elif station.clientraw != '':
+                import filewatch
+                self.engine.add_file(filewatch.FileSource(station.clientraw,
+                        station.udp_data, station.file_interval))
+            else:
+                self.engine.add_multicast(station.mcast_ip, station.udp_port,
+                        station.udp_data)
+        self.open_api()
+        self.engine.every(lambda: self.publish_interval, self.publish)
+        self.engine.every(lambda: self.state_interval, self.save_state)
+        self.engine.start(publisher=False)
+        timing.lap('receiver')
+
+        t = threading.Thread(target=self.finish_start, args=(timing,))
+        t.daemon = True
+        t.start()
+
+    def finish_start(self, timing):
+        try:
+            self.open_history()
+            timing.lap('history')
+            with self.config_lock:
+                self.map_nodes(self.polyConfig)
+                timing.lap('profile')
+                LOGGER.info('Calling discover')
+                self.discover()
+                timing.lap('discover')
+            self.open_journal()
+            self.restore_state()
+            self.update_cache()
+            timing.lap('state')
+
+            # Now the plans exist the queued packets can be processed.
+            self.engine.start_publisher()
+            LOGGER.info('WeatherDisplay Node Server Started.')
+
+            self.remove_old_nodes()
+            timing.lap('cleanup')
+        except Exception as e:
+            LOGGER.error('Startup failed: {}'.format(e), exc_info=True)
+        LOGGER.info('Startup: ' + timing.report())
 
     def shortPoll(self):
         pass
@@ -100,118 +180,181 @@ class Controller(polyinterface.Controller):
                 - Light (UV, solar radiation, lux)
                 - Lightning (strikes, distance)
 
-        The nodes need to have thier drivers configured based on the user
-        supplied configuration. To that end, we should probably create the
-        node, update the driver list, set the units and then add the node.
+        Each station gets its own set of nodes.
         """
 
         LOGGER.info("Creating nodes.")
-
-        if len(self.temperature_map) > 0:
-            LOGGER.info("Creating Temperature node")
-            node = TemperatureNode(self, self.address, 'temperature',
-                    'Temperatures')
-            node.SetUnits(self.units)
-
-            # self.temperature_list - list of values with units
-            # self.temperature_map - list driver/field pairs
-            # if we added units to the driver/field list, that would help.
-            for d in self.temperature_map:
-                # {'driver': 'ST', 'value': 0, 'uom': 2},
-                node.drivers.append(
-                    {'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]}
-                    )
-            self.addNode(node)
-
-        if len(self.humidity_map) > 0:
-            LOGGER.info("Creating Humidity node")
-            node = HumidityNode(self, self.address, 'humidity', 'Humidity')
-            for d in self.humidity_map:
-                node.drivers.append(
-                    {'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]}
-                    )
-            self.addNode(node)
-
-        if len(self.pressure_map) > 0:
-            LOGGER.info("Creating Pressure node")
-            node = PressureNode(self, self.address, 'pressure', 'Barometric Pressure')
-            node.SetUnits(self.units)
-            for d in self.pressure_map:
-                node.drivers.append(
-                    {'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]}
-                    )
-            self.addNode(node)
-
-        if len(self.wind_map) > 0:
-            LOGGER.info("Creating Wind node")
-            node = WindNode(self, self.address, 'wind', 'Wind')
-            node.SetUnits(self.units)
-            for d in self.wind_map:
-                node.drivers.append(
-                    {'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]}
-                    )
-            self.addNode(node)
-
-        if len(self.rain_map) > 0:
-            LOGGER.info("Creating Precipitation node")
-            node = PrecipitationNode(self, self.address, 'rain', 'Precipitation')
-            node.SetUnits(self.units)
-            for d in self.rain_map:
-                node.drivers.append(
-                    {'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]}
-                    )
-            self.addNode(node)
-
-        if len(self.light_map) > 0:
-            LOGGER.info("Creating Light node")
-            node = LightNode(self, self.address, 'light', 'Illumination')
-            for d in self.light_map:
-                node.drivers.append(
-                    {'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]}
-                    )
-            self.addNode(node)
-
-        if len(self.lightning_map) > 0:
-            LOGGER.info("Creating Lightning node")
-            node = LightningNode(self, self.address, 'lightning', 'Lightning')
-            node.SetUnits(self.units)
-            for d in self.lightning_map:
-                node.drivers.append(
-                    {'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]}
-                    )
-            self.addNode(node)
+        for station in self.stations.values():
+            station.discover()
+            station.compile_plan()
+        self.register_state()
+
+    def publish(self, now):
+        t0 = time.perf_counter()
+        for station in self.stations.values():
+            station.publish(now)
+        self.metrics.publish.add(time.perf_counter() - t0)
+        self.report_metrics()
+        self.update_cache()
+
+    def report_metrics(self):
+        m = self.metrics
+        self.setDriver('GV0', m.received())
+        self.setDriver('GV1', m.skipped())
+        self.setDriver('GV2', m.rejected)
+        self.setDriver('GV3', m.queue_depth())
+        self.setDriver('GV4', round(m.parse.percentile(99) * 1000, 3))
+        self.setDriver('GV5', round(m.convert.percentile(99) * 1000, 3))
+        self.setDriver('GV6', round(m.publish.percentile(99) * 1000, 3))
+        m.roll()
+
+        if self.metrics_file != '':
+            try:
+                m.dump(self.metrics_file)
+            except (OSError, ValueError) as e:
+                LOGGER.error('Unable to write metrics file: {}'.format(e))
 
     def remove_old_nodes(self):
-        if len(self.lightning_map) == 0:
-            LOGGER.info('Deleting orphaned lightning node')
-            self.delNode('lightning')
-        if len(self.temperature_map) == 0:
-            LOGGER.info('Deleting orphaned temperature node')
-            self.delNode('temperature')
-        if len(self.humidity_map) == 0:
-            LOGGER.info('Deleting orphaned humidity node')
-            self.delNode('humidity')
-        if len(self.wind_map) == 0:
-            LOGGER.info('Deleting orphaned wind node')
-            self.delNode('wind')
-        if len(self.light_map) == 0:
-            LOGGER.info('Deleting orphaned light node')
-            self.delNode('light')
-        if len(self.rain_map) == 0:
-            LOGGER.info('Deleting orphaned rain node')
-            self.delNode('rain')
-        if len(self.pressure_map) == 0:
-            LOGGER.info('Deleting orphaned pressure node')
-            self.delNode('pressure')
+        for station in self.stations.values():
+            station.remove_old_nodes()
+
+        # Nodes of stations that are no longer configured. Polyglot
+        # reports every node it has for this node server, including the
+        # ones from earlier runs.
+        current = set([self.address])
+        for station in self.stations.values():
+            current.update(address for (address, c, m) in station.node_maps())
+        known = set(node['address'] for node in self.polyConfig.get('nodes', []))
+        known.update(self.nodes)
+        for address in sorted(known - current):
+            LOGGER.info('Deleting %s node of a removed station' % address)
+            self.delNode(address)
 
     def delete(self):
         self.stopping = True
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine.join(2)
+        self.save_state()
+        self.close_journal()
+        self.close_history()
         LOGGER.info('Removing WeatherDisplay node server.')
 
     def stop(self):
         self.stopping = True
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine.join(2)
+        self.save_state()
+        self.close_journal()
+        self.close_history()
         LOGGER.debug('Stopping WeatherDisplay node server.')
 
+    def open_journal(self):
+        # Optional journal of every packet received. Additional stations
+        # are journaled in a sub-directory named for the station.
+        params = self.polyConfig['customParams']
+        if params.get('Journal', '') == '':
+            return
+        for station in self.stations.values():
+            path = os.path.join(params['Journal'], station.name)
+            try:
+                station.journal = journal.Journal(path,
+                        segments=int(params.get('JournalSegments', 24)))
+                LOGGER.info('Journaling packets to ' + path)
+            except (OSError, ValueError) as e:
+                LOGGER.error('Unable to open packet journal: {}'.format(e))
+                station.journal = None
+
+    def close_journal(self):
+        for station in self.stations.values():
+            if station.journal is not None:
+                station.journal.close()
+                station.journal = None
+
+    def open_history(self):
+        # Optional history of every mapped field, see history.py
+        params = self.polyConfig['customParams']
+        if params.get('History', '') == '':
+            return
+        import history  # sqlite3 is only loaded when it's used
+        retention = {}
+        days = params.get('HistoryRetention', '')
+        try:
+            for tier, value in zip(history.TIERS, days.split(',') if days else []):
+                retention[tier] = float(value)
+            self.history = history.History(params['History'], LOGGER, retention)
+        except (ValueError, history.sqlite3.Error) as e:
+            LOGGER.error('Unable to open history: {}'.format(e))
+            self.history = None
+            return
+        self.history.start()
+        LOGGER.info('Recording history to ' + params['History'])
+
+    def open_api(self):
+        # Optional local HTTP API, see api.py. It's served by the receive
+        # loop from a cache rebuilt every publish interval.
+        if not self.api_port:
+            return
+        import api
+        cache = api.Cache()
+        server = api.Server(cache, LOGGER, self.metrics, lambda: self.history)
+        try:
+            self.engine.add_server(self.api_address, self.api_port, server.handle)
+        except OSError as e:
+            LOGGER.error('Unable to start the API on port %d: %s' % (self.api_port, e))
+            return
+        self.cache = cache
+        LOGGER.info('Serving the API on %s:%d' % (self.api_address, self.api_port))
+
+    def update_cache(self):
+        if self.cache is None:
+            return
+        nodes = [self]
+        for station in self.stations.values():
+            nodes.extend(station.plan.nodes)
+        self.cache.update(nodes)
+
+    def close_history(self):
+        if self.history is not None:
+            self.history.stop(10)
+            self.history = None
+
+    def restore_state(self):
+        # Load the last snapshot and hand it to the nodes.
+        if self.state_file == '':
+            return
+        self.snapshot = state.Snapshot(self.state_file, LOGGER)
+        self.snapshot.load()
+        self.register_state()
+
+    def register_state(self):
+        if self.snapshot is None:
+            return
+        keys = []
+        for station in self.stations.values():
+            for node in station.plan.nodes:
+                for (name, obj) in node.stateful():
+                    keys.append(node.address + '/' + name)
+                    self.snapshot.register(keys[-1], obj)
+        # Forget anything that's no longer configured.
+        self.snapshot.keep(keys)
+
+    def save_state(self, now=None):
+        if self.snapshot is None:
+            return
+        try:
+            self.snapshot.save()
+        except (OSError, ValueError, TypeError) as e:
+            LOGGER.error('Unable to save state: {}'.format(e))
+
+    def stream_stalled(self, source):
+        self.addNotice({'stalled': 'No data received from Weather Display on ' + source.name})
+
+    def stream_resumed(self, source):
+        if not any(s.stalled for s in self.engine.inputs()):
+            self.removeNotice('stalled')
+
     def check_params(self):
 
         self.set_configuration(self.polyConfig)
@@ -222,6 +365,12 @@ class Controller(polyinterface.Controller):
                     'UDPPort': self.udp_port,
                     'IPAddress': self.mcast_ip,
                     'Units': self.units,
+                    'Heartbeat': self.heartbeat,
+                    'PublishInterval': self.publish_interval,
+                    'StallTimeout': self.stall_timeout,
+                    'QueueSize': self.queue_size,
+                    'QueuePolicy': self.queue_policy,
+                    'Elevation': self.elevation,
                     'temperature-main': 4,
                     'temperature-heatindex': 45,
                     'temperature-windchill': 44,
@@ -237,8 +386,7 @@ class Controller(polyinterface.Controller):
                     'light-solar_percent': 34,
                     })
 
-        self.map_nodes(self.polyConfig)
-        self.myConfig = self.polyConfig['customParams']
+        self.myConfig = dict(self.polyConfig['customParams'])
 
         # Remove all existing notices
         LOGGER.info("remove all notices")
@@ -250,6 +398,11 @@ class Controller(polyinterface.Controller):
         default_port = 1333
         default_mcast_ip = "231.31.31.31"
         default_elevation = 0
+        default_heartbeat = 600
+        default_publish_interval = 30
+        default_stall_timeout = 120
+        default_queue_size = 256
+        default_queue_policy = 'drop-oldest'
 
         LOGGER.info("Check for existing configuration value")
 
@@ -263,72 +416,455 @@ class Controller(polyinterface.Controller):
         else:
             self.mcast_ip = default_mcast_ip
 
-        if 'Units' in config['customParams']:
+        if config['customParams'].get('Units', '') in uom.UNIT_SYSTEMS:
             self.units = config['customParams']['Units']
         else:
+            if config['customParams'].get('Units', '') != '':
+                LOGGER.error('Invalid units ' + config['customParams']['Units'])
             self.units = 'metric'
 
+        # Maximum time, in seconds, a driver may go without being reported
+        if 'Heartbeat' in config['customParams']:
+            self.heartbeat = int(config['customParams']['Heartbeat'])
+        else:
+            self.heartbeat = default_heartbeat
+
+        # How often, in seconds, the aggregated values are sent on
+        if 'PublishInterval' in config['customParams']:
+            self.publish_interval = float(config['customParams']['PublishInterval'])
+        else:
+            self.publish_interval = default_publish_interval
+
+        # Station elevation in meters, used for sea level pressure
+        if 'Elevation' in config['customParams']:
+            self.elevation = float(config['customParams']['Elevation'])
+        else:
+            self.elevation = default_elevation
+
+        # Warn when no packets have been received for this many seconds
+        if 'StallTimeout' in config['customParams']:
+            self.stall_timeout = int(config['customParams']['StallTimeout'])
+        else:
+            self.stall_timeout = default_stall_timeout
+        if self.engine is not None:
+            self.engine.stall_timeout = self.stall_timeout
+
+        # Optional file the runtime metrics are written to as JSON
+        self.metrics_file = config['customParams'].get('MetricsFile', '')
+
+        # Where, and how often in seconds, the rolling state (trends,
+        # totals, ...) is saved so it survives a restart.
+        self.state_file = config['customParams'].get('StateFile', 'state.json')
+        if 'StateInterval' in config['customParams']:
+            self.state_interval = float(config['customParams']['StateInterval'])
+        else:
+            self.state_interval = 300
+
+        # Local HTTP API, disabled unless a port is set. Takes effect when
+        # the node server is restarted.
+        if config['customParams'].get('APIPort', '') != '':
+            self.api_port = int(config['customParams']['APIPort'])
+        else:
+            self.api_port = 0
+        self.api_address = config['customParams'].get('APIAddress', '127.0.0.1')
+
+        # Packets waiting to be processed and what to do when that fills up.
+        # These take effect when the node server is restarted.
+        if 'QueueSize' in config['customParams']:
+            self.queue_size = int(config['customParams']['QueueSize'])
+        else:
+            self.queue_size = default_queue_size
+
+        if config['customParams'].get('QueuePolicy', '') in receiver.POLICIES:
+            self.queue_policy = config['customParams']['QueuePolicy']
+        else:
+            if 'QueuePolicy' in config['customParams']:
+                LOGGER.error('Invalid queue policy ' + config['customParams']['QueuePolicy'])
+            self.queue_policy = default_queue_policy
+
+        # The primary station plus any listed in Stations. Existing station
+        # objects are kept since the receive loop holds on to them.
+        # Node addresses only use the first 8 characters of the name so
+        # those have to be unique.
+        names = ['']
+        prefixes = {}
+        for name in config['customParams'].get('Stations', '').split(','):
+            name = name.strip().lower()
+            if name == '' or name in names:
+                continue
+            if not name.isalnum():
+                LOGGER.error('Invalid station name ' + name)
+                continue
+            if name[:8] in prefixes:
+                LOGGER.error('Station name %s is too close to %s, the first 8 characters must differ' %
+                        (name, prefixes[name[:8]]))
+                continue
+            prefixes[name[:8]] = name
+            names.append(name)
+
+        stations = {}
+        for name in names:
+            stations[name] = self.stations.get(name) or Station(self, name)
+            stations[name].set_configuration(config['customParams'])
+        self.stations = stations
+
     def map_nodes(self, config):
         # Build up our data mapping table. The customParams keys will
         # look like temperature.main and the value will be WD field #
         LOGGER.info("Trying to create a mapping")
-        for key in config['customParams']:
-            if not '-' in key:
+        nodedefs = []
+        for station in self.stations.values():
+            station.map_nodes(config['customParams'])
+            nodedefs.extend(station.nodedefs())
+
+        # Build the node definition
+        LOGGER.info('Try to create node definition profile based on config.')
+        digest = write_profile.write_nodedefs(LOGGER, nodedefs)
+
+        # push updated profile to ISY, only if it changed
+        if digest is not None:
+            try:
+                self.poly.installprofile()
+            except:
+                LOGGER.error('Failed up push profile to ISY')
+                return None
+            write_profile.save_profile_hash(digest)
+
+    def remove_notices_all(self,command):
+        LOGGER.info('remove_notices_all:')
+        # Remove all existing notices
+        self.removeNoticesAll()
+
+    def update_profile(self,command):
+        LOGGER.info('update_profile:')
+        st = self.poly.installprofile()
+        return st
+
+    def SetUnits(self, u):
+        self.units = u
+
+
+    CONFIG_DELAY = 2.0
+
+    id = 'WeatherDisplay'
+    name = 'WeatherDisplayPoly'
+    address = 'weather'
+    stopping = False
+    hint = 0xffffff
+    units = 'metric'
+    commands = {
+        'DISCOVER': discover,
+        'UPDATE_PROFILE': update_profile,
+        'REMOVE_NOTICES_ALL': remove_notices_all
+    }
+    # Node server status: packet counters, queue depth and the 99th
+    # percentile processing times in milliseconds.
+    drivers = [
+            {'driver': 'ST', 'value': 1, 'uom': 2},
+            {'driver': 'GV0', 'value': 0, 'uom': 56},  # Packets received
+            {'driver': 'GV1', 'value': 0, 'uom': 56},  # Packets skipped
+            {'driver': 'GV2', 'value': 0, 'uom': 56},  # Rejected packets
+            {'driver': 'GV3', 'value': 0, 'uom': 56},  # Queue depth
+            {'driver': 'GV4', 'value': 0, 'uom': 42},  # Parse time
+            {'driver': 'GV5', 'value': 0, 'uom': 42},  # Convert time
+            {'driver': 'GV6', 'value': 0, 'uom': 42},  # Publish time
+            ]
+
+
+# Everything the packet handler and publisher need, swapped as a whole
+# when the configuration changes:
+#   entries - (node, driver, field index, converter, deadband, window)
+#   nodes - the nodes to flush after publishing
+#   samplers - (push, field index) run for every packet
+#   last_index - highest field index used
+#   history - (history series id, field index) recorded for every packet
+#   indexes - the distinct field indexes sampled, checked by validate()
+#   gaps - (window skip, field index) for the raw windows, run when the
+#          field is a placeholder so windows used together stay in step
+Plan = collections.namedtuple('Plan', 'entries nodes samplers last_index history indexes gaps')
+
+# Every clientraw packet starts with this.
+HEADER = b'12345'
+
+# What Weather Display sends for a value it doesn't have.
+MISSING = frozenset((b'-', b'--', b'---', b'-.-', b'N/A'))
+
+# Plain decimal numbers, what float() accepts apart from nan, inf, etc.
+# An exponent can still overflow to inf so validate() also checks that
+# the value is finite.
+NUMBER = re.compile(rb'[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?$')
+
+
+
+def driver_number(driver):
+    # Sort key for driver ids, ST comes before GV0.
+    if driver == 'ST':
+        return -1
+    return int(driver[2:])
+
+class StartupTimer(object):
+    """ Time taken by each step of the node server startup. """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.laps = []
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.laps.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        steps = ', '.join('%s %.1f ms' % (n, t * 1000) for n, t in self.laps)
+        return '%s, total %.1f ms' % (steps, (self.last - self.start) * 1000)
+
+
+class Station(object):
+    """
+    A Weather Display source: the multicast group/port it sends on, how
+    its fields map to node drivers and the compiled plan used to process
+    its packets.
+
+    The primary station (name '') uses the plain configuration keys and
+    node addresses. Additional stations, listed in the Stations custom
+    parameter, prefix their keys with the station name (barn.IPAddress,
+    barn.temperature-main) and get node addresses like barn_temp.
+    """
+
+    # (config name, node name) for each sensor node, in node_maps() order
+    NODES = (
+            ('temperature', 'Temperatures'),
+            ('humidity', 'Humidity'),
+            ('pressure', 'Barometric Pressure'),
+            ('wind', 'Wind'),
+            ('rain', 'Precipitation'),
+            ('light', 'Illumination'),
+            ('lightning', 'Lightning'),
+            )
+
+    # Node address suffixes for additional stations. Addresses are limited
+    # to 14 characters so the station name is truncated to 8.
+    SHORT = {
+            'temperature' : 'temp',
+            'humidity' : 'humid',
+            'pressure' : 'press',
+            'wind' : 'wind',
+            'rain' : 'rain',
+            'light' : 'light',
+            'lightning' : 'ltng',
+            }
+
+    def __init__(self, controller, name=''):
+        self.controller = controller
+        self.name = name
+        self.key_prefix = name + '.' if name else ''
+        self.mcast_ip = controller.mcast_ip
+        self.udp_port = controller.udp_port
+        self.elevation = controller.elevation
+        self.clientraw = ''
+        self.file_interval = 2.0
+        self.clientraw_url = ''
+        self.clientraw_extra = False
+        self.url_interval = 10.0
+        self.senders = frozenset()
+        self.journal = None
+        self.deadbands = {}
+        self.aggregates = {}
+        self.temperature_list = {}
+        self.humidity_list = {}
+        self.pressure_list = {}
+        self.wind_list = {}
+        self.rain_list = {}
+        self.light_list = {}
+        self.lightning_list = {}
+        self.temperature_map = []
+        self.humidity_map = []
+        self.pressure_map = []
+        self.wind_map = []
+        self.rain_map = []
+        self.light_map = []
+        self.lightning_map = []
+        self.extremes = {}        # (node name, field) -> periods tracked
+        self.extreme_drvs = {}    # node name -> {key: driver} allocated
+        self.extreme_names = {}   # node name -> {driver: (field driver, label)}
+        self.extreme_sources = {} # (node name, driver) -> (field driver, period, kind, periods)
+        self.plan = Plan((), (), (), -1, (), (), ())
+
+    def address(self, base):
+        if self.name == '':
+            return base
+        return self.name[:8] + '_' + self.SHORT[base]
+
+    def node_name(self, name):
+        if self.name == '':
+            return name
+        return self.name.capitalize() + ' ' + name
+
+    def set_configuration(self, params):
+        # Read clientraw.txt instead of listening for UDP packets when a
+        # file is given. Checked every ClientrawInterval seconds when it
+        # can't be watched.
+        self.clientraw = params.get(self.key_prefix + 'ClientrawFile', '')
+        try:
+            self.file_interval = float(params.get('ClientrawInterval', 2))
+        except ValueError:
+            LOGGER.error('Invalid ClientrawInterval ' + params['ClientrawInterval'])
+            self.file_interval = 2.0
+
+        # Or poll it from the web server Weather Display uploads it to,
+        # along with clientrawextra.txt if ClientrawExtra is true.
+        self.clientraw_url = params.get(self.key_prefix + 'ClientrawURL', '')
+        self.clientraw_extra = params.get(self.key_prefix + 'ClientrawExtra',
+                'false').lower() in ('true', 'yes', '1')
+        try:
+            self.url_interval = float(params.get('ClientrawURLInterval', 10))
+        except ValueError:
+            LOGGER.error('Invalid ClientrawURLInterval ' + params['ClientrawURLInterval'])
+            self.url_interval = 10.0
+
+        # Only accept UDP packets from these addresses, if any are given.
+        senders = params.get(self.key_prefix + 'AllowedSenders', '')
+        if self.clientraw_url != '' or self.clientraw != '':
+            senders = ''
+        self.senders = frozenset(a.strip() for a in senders.split(',') if a.strip())
+
+        if self.name == '':
+            self.mcast_ip = self.controller.mcast_ip
+            self.udp_port = self.controller.udp_port
+            self.elevation = self.controller.elevation
+            return
+
+        self.mcast_ip = params.get(self.key_prefix + 'IPAddress', self.controller.mcast_ip)
+        try:
+            self.udp_port = int(params.get(self.key_prefix + 'UDPPort', self.controller.udp_port))
+            self.elevation = float(params.get(self.key_prefix + 'Elevation', self.controller.elevation))
+        except ValueError:
+            LOGGER.error('Invalid configuration for station ' + self.name)
+
+    def node_maps(self):
+        # (node address, node class, driver/field map) for each sensor node
+        return (
+                (self.address('temperature'), TemperatureNode, self.temperature_map),
+                (self.address('humidity'), HumidityNode, self.humidity_map),
+                (self.address('pressure'), PressureNode, self.pressure_map),
+                (self.address('wind'), WindNode, self.wind_map),
+                (self.address('rain'), PrecipitationNode, self.rain_map),
+                (self.address('light'), LightNode, self.light_map),
+                (self.address('lightning'), LightningNode, self.lightning_map),
+                )
+
+    def nodedefs(self):
+        # Node definitions for this station's nodes. The primary station
+        # uses the node class id, others use the node address so that
+        # each station can have a different set of drivers.
+        defs = []
+        address_base = dict((self.address(b), b) for (b, n) in self.NODES)
+        for (address, node_class, node_map), edit_list, drvs, nls in zip(
+                self.node_maps(),
+                (self.temperature_list, self.humidity_list,
+                    self.pressure_list, self.wind_list, self.rain_list,
+                    self.light_list, self.lightning_list),
+                (write_profile.TEMP_DRVS, write_profile.HUMD_DRVS,
+                    write_profile.PRES_DRVS, write_profile.WIND_DRVS,
+                    write_profile.RAIN_DRVS, write_profile.LITE_DRVS,
+                    write_profile.LTNG_DRVS),
+                ('139T', '139H', '139P', '139W', '139R', '139L', '139S')):
+            node_id = node_class.id if self.name == '' else address
+            base = address_base[address]
+            if base in self.extreme_drvs:
+                drvs = dict(drvs, **self.extreme_drvs[base])
+            defs.append((node_id, nls, drvs, edit_list,
+                self.extreme_names.get(base, {})))
+        return defs
+
+    def map_nodes(self, params):
+        # The maps are rebuilt from scratch every time so they only ever
+        # hold the current configuration.
+        units = self.controller.units
+        self.deadbands = {}
+        self.aggregates = {}
+        self.extremes = {}
+        self.temperature_list = {}
+        self.humidity_list = {}
+        self.pressure_list = {}
+        self.wind_list = {}
+        self.rain_list = {}
+        self.light_list = {}
+        self.lightning_list = {}
+        self.temperature_map = []
+        self.humidity_map = []
+        self.pressure_map = []
+        self.wind_map = []
+        self.rain_map = []
+        self.light_map = []
+        self.lightning_map = []
+        for key in params:
+            # Only the keys for this station
+            if self.key_prefix != '':
+                if not key.startswith(self.key_prefix):
+                    continue
+                name = key[len(self.key_prefix):]
+            elif '.' in key:
+                continue
+            else:
+                name = key
+
+            if not '-' in name:
                 LOGGER.info("skipping " + key)
                 continue
 
-            vmap = key.split('-')
+            vmap = name.split('-')
             # Mapping needs to be a list for each node and each list item
             # is a 2 element list (or a dictionary?)
 
             if vmap[0] == 'temperature':
-                self.temperature_list[vmap[1]] = 'I_TEMP_F' if self.units == 'us' else 'I_TEMP_C'
+                self.temperature_list[vmap[1]] = uom.editor('temperature', units)
                 mapper = [ write_profile.TEMP_DRVS[vmap[1]],
-                        config['customParams'][key],
+                        params[key],
                         self.temperature_list[vmap[1]]
                         ]
                 self.temperature_map.append(mapper)
             elif vmap[0] == 'humidity':
                 self.humidity_list[vmap[1]] = 'I_HUMIDITY'
                 mapper = [ write_profile.HUMD_DRVS[vmap[1]],
-                        config['customParams'][key],
+                        params[key],
                         self.humidity_list[vmap[1]]
                         ]
                 self.humidity_map.append(mapper)
             elif vmap[0] == 'pressure':
                 if vmap[1] == 'trend':
-                    self.pressure_list[vmap[1]] = 'I_TREND_INHG' if self.units == 'us' else 'I_TREND_MB'
+                    self.pressure_list[vmap[1]] = uom.editor('trend', units)
                 else:
-                    self.pressure_list[vmap[1]] = 'I_INHG' if self.units == 'us' else 'I_MB'
+                    self.pressure_list[vmap[1]] = uom.editor('pressure', units)
                 mapper = [ write_profile.PRES_DRVS[vmap[1]],
-                        config['customParams'][key],
+                        params[key],
                         self.pressure_list[vmap[1]]
                         ]
                 self.pressure_map.append(mapper)
             elif vmap[0] == 'wind':
                 if 'speed' in vmap[1]:
-                    self.wind_list[vmap[1]] = 'I_KPH' if self.units == 'metric' else 'I_MPH'
+                    self.wind_list[vmap[1]] = uom.editor('speed', units)
                 else:
                     self.wind_list[vmap[1]] = 'I_DEGREE'
                 mapper = [ write_profile.WIND_DRVS[vmap[1]],
-                        config['customParams'][key],
+                        params[key],
                         self.wind_list[vmap[1]]
                         ]
                 self.wind_map.append(mapper)
             elif vmap[0] == 'rain':
                 if 'rate' in vmap[1]:
-                    self.rain_list[vmap[1]] = 'I_MMHR' if self.units == 'metric' else 'I_INHR'
+                    self.rain_list[vmap[1]] = uom.editor('rate', units)
                 else:
-                    self.rain_list[vmap[1]] = 'I_MM' if self.units == 'metric' else 'I_INCHES'
+                    self.rain_list[vmap[1]] = uom.editor('depth', units)
                 mapper = [ write_profile.RAIN_DRVS[vmap[1]],
-                        config['customParams'][key],
+                        params[key],
                         self.rain_list[vmap[1]]
                         ]
                 self.rain_map.append(mapper)
             elif vmap[0] == 'light':
                 self.light_list[vmap[1]] = write_profile.LITE_EDIT[vmap[1]]
                 mapper = [ write_profile.LITE_DRVS[vmap[1]],
-                        config['customParams'][key],
+                        params[key],
                         self.light_list[vmap[1]]
                         ]
                 self.light_map.append(mapper)
@@ -336,119 +872,470 @@ class Controller(polyinterface.Controller):
                 if 'strike' in vmap[1]:
                     self.lightning_list[vmap[1]] = 'I_STRIKES'
                 else:
-                    self.lightning_list[vmap[1]] = 'I_KM' if self.units == 'metric' else 'I_MILE'
+                    self.lightning_list[vmap[1]] = uom.editor('distance', units)
                 mapper = [ write_profile.LTNG_DRVS[vmap[1]],
-                        config['customParams'][key],
+                        params[key],
                         self.lightning_list[vmap[1]]
                         ]
                 self.lightning_map.append(mapper)
+            elif vmap[0] == 'deadband' and len(vmap) == 3:
+                # deadband-<node>-<field> = minimum change, in the user's
+                # units, before a new value is reported.
+                try:
+                    driver = write_profile.NODE_DRVS[vmap[1]][vmap[2]]
+                    self.deadbands[(vmap[1], driver)] = float(params[key])
+                except (KeyError, ValueError):
+                    LOGGER.error('Invalid deadband configuration ' + key)
+            elif vmap[0] == 'aggregate' and len(vmap) == 3:
+                # aggregate-<node>-<field> = mean, min, max or last
+                mode = params[key]
+                if vmap[1] in write_profile.NODE_DRVS and \
+                        vmap[2] in write_profile.NODE_DRVS[vmap[1]] and \
+                        mode in aggregate.MODES:
+                    driver = write_profile.NODE_DRVS[vmap[1]][vmap[2]]
+                    self.aggregates[(vmap[1], driver)] = mode
+                else:
+                    LOGGER.error('Invalid aggregate configuration ' + key)
+            elif vmap[0] == 'extremes' and len(vmap) == 3:
+                # extremes-<node>-<field> = daily, rolling and/or alltime
+                periods = [p.strip() for p in params[key].split(',') if p.strip()]
+                if vmap[1] in write_profile.NODE_DRVS and \
+                        vmap[2] in write_profile.NODE_DRVS[vmap[1]] and \
+                        len(periods) > 0 and \
+                        all(p in extremes.PERIODS for p in periods):
+                    self.extremes[(vmap[1], vmap[2])] = periods
+                else:
+                    LOGGER.error('Invalid extremes configuration ' + key)
+
+        self.map_extremes()
+
+    # Labels for the extreme drivers, appended to the field's name
+    EXTREME_LABELS = {
+            ('daily', 'min') : 'Daily Low',
+            ('daily', 'max') : 'Daily High',
+            ('rolling', 'min') : '24 Hour Low',
+            ('rolling', 'max') : '24 Hour High',
+            ('alltime', 'min') : 'Record Low',
+            ('alltime', 'max') : 'Record High',
+            }
+
+    def map_extremes(self):
+        # Each field has its own block of min/max drivers after the last
+        # driver in the node's table, one pair per period, in the order
+        # of the field's own driver. A driver always means the same value
+        # whatever else is tracked; fields whose block would go past the
+        # last GV the ISY has can't be tracked.
+        edit_lists = dict(zip([b for (b, n) in self.NODES],
+                (self.temperature_list, self.humidity_list,
+                    self.pressure_list, self.wind_list, self.rain_list,
+                    self.light_list, self.lightning_list)))
+        maps = dict(zip([b for (b, n) in self.NODES],
+                [m for (a, c, m) in self.node_maps()]))
+        block = 2 * len(extremes.PERIODS)
+        self.extreme_drvs = {}
+        self.extreme_names = {}
+        self.extreme_sources = {}
+        for (base, field) in sorted(self.extremes):
+            table = write_profile.NODE_DRVS[base]
+            if field not in edit_lists[base]:
+                LOGGER.error('extremes-%s-%s needs %s-%s mapped' %
+                        (base, field, base, field))
+                continue
+            source = table[field]
+            fields = sorted(table.values(), key=driver_number)
+            first = driver_number(fields[-1]) + 1 + fields.index(source) * block
+            if first + block - 1 > write_profile.MAX_GV:
+                LOGGER.error('extremes-%s-%s would need drivers past GV%d' %
+                        (base, field, write_profile.MAX_GV))
+                continue
+            drvs = self.extreme_drvs.setdefault(base, {})
+            names = self.extreme_names.setdefault(base, {})
+            for p, period in enumerate(extremes.PERIODS):
+                if period not in self.extremes[(base, field)]:
+                    continue
+                for k, kind in enumerate(('min', 'max')):
+                    driver = 'GV%d' % (first + 2 * p + k)
+                    key = '%s-%s-%s' % (field, period, kind)
+                    drvs[key] = driver
+                    names[driver] = (source, self.EXTREME_LABELS[(period, kind)])
+                    self.extreme_sources[(base, driver)] = (source, period, kind,
+                            self.extremes[(base, field)])
+                    edit_lists[base][key] = edit_lists[base][field]
+                    maps[base].append([driver, 'extreme', edit_lists[base][field]])
+
+    def discover(self):
+        """
+        The nodes need to have thier drivers configured based on the user
+        supplied configuration. To that end, we should probably create the
+        node, update the driver list, set the units and then add the node.
 
-        # Build the node definition
-        LOGGER.info('Try to create node definition profile based on config.')
-        write_profile.write_profile(LOGGER, self.temperature_list,
-                self.humidity_list, self.pressure_list, self.wind_list,
-                self.rain_list, self.light_list, self.lightning_list)
-
-        # push updated profile to ISY
-        try:
-            self.poly.installprofile()
-        except:
-            LOGGER.error('Failed up push profile to ISY')
-
-    def remove_notices_all(self,command):
-        LOGGER.info('remove_notices_all:')
-        # Remove all existing notices
-        self.removeNoticesAll()
-
-    def update_profile(self,command):
-        LOGGER.info('update_profile:')
-        st = self.poly.installprofile()
-        return st
-
-    def udp_data(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((self.mcast_ip, self.udp_port))
-        mreq = struct.pack("4sl", socket.inet_aton(self.mcast_ip), socket.INADDR_ANY)
-        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-        windspeed = 0
-        counter = 0
-
-        LOGGER.info("Starting UDP receive loop")
-        while self.stopping == False:
-            wd_data = s.recvfrom(1024)
-
-            # Data from Weather Display is being sent every second, that's
-            # way to fast to process and send on to the ISY.  Instead, let's
-            # try every 30th packet
-
-            counter += 1
-            if counter < 30:
-                continue # skip this data
-
-            LOGGER.info('Counter: %d' % counter)
-            counter = 0
-
-            data = wd_data[0].decode("utf-8") # wd_data is a truple (data, ip, port)
-            fields = data.split()
-
-            # loop through the various mappings and update the drivers.
-            if len(self.temperature_map) > 0:
-                for d in self.temperature_map:
-                    self.nodes['temperature'].setDriver(d[0], float(fields[int(d[1])]))
-            if len(self.humidity_map) > 0:
-                for d in self.humidity_map:
-                    self.nodes['humidity'].setDriver(d[0], int(fields[int(d[1])]))
-
-            if len(self.pressure_map) > 0:
-                for d in self.pressure_map:
-                    self.nodes['pressure'].setDriver(d[0], float(fields[int(d[1])]))
-
-            if len(self.lightning_map) > 0:
-                for d in self.lightning_map:
-                    self.nodes['lightning'].setDriver(d[0], int(fields[int(d[1])]))
-
-            if len(self.wind_map) > 0:
-                for d in self.wind_map:
-                    self.nodes['wind'].setDriver(d[0], float(fields[int(d[1])]))
-
-            if len(self.light_map) > 0:
-                for d in self.light_map:
-                    self.nodes['light'].setDriver(d[0], float(fields[int(d[1])]))
-
-            if len(self.rain_map) > 0:
-                for d in self.rain_map:
-                    self.nodes['rain'].setDriver(d[0], float(fields[int(d[1])]))
-
-        LOGGER.info('UDP socket closing.')
-        s.close()
-
-    def SetUnits(self, u):
-        self.units = u
-
+        Nodes that already exist are kept, along with their state, and only
+        updated if their drivers have changed.
+        """
+        units = self.controller.units
+        for (address, node_class, node_map), (base, name) in zip(
+                self.node_maps(), self.NODES):
+            if len(node_map) == 0:
+                continue
 
-    id = 'WeatherDisplay'
-    name = 'WeatherDisplayPoly'
-    address = 'weather'
-    stopping = False
-    hint = 0xffffff
-    units = 'metric'
-    commands = {
-        'DISCOVER': discover,
-        'UPDATE_PROFILE': update_profile,
-        'REMOVE_NOTICES_ALL': remove_notices_all
-    }
-    # Hub status information here: battery and rssi values.
-    drivers = [
-            {'driver': 'ST', 'value': 1, 'uom': 2},
-            {'driver': 'GV0', 'value': 0, 'uom': 72},  # Air battery level
-            {'driver': 'GV1', 'value': 0, 'uom': 72},  # Sky battery level
-            {'driver': 'GV2', 'value': 0, 'uom': 25},  # Air RSSI
-            {'driver': 'GV3', 'value': 0, 'uom': 25}   # Sky RSSI
-            ]
+            # node_map - list driver/field/editor
+            drivers = []
+            for d in node_map:
+                # {'driver': 'ST', 'value': 0, 'uom': 2},
+                drivers.append({'driver': d[0], 'value': 0, 'uom': uom.UOM[d[2]]})
+
+            node = self.controller.nodes.get(address)
+            if isinstance(node, node_class):
+                current = dict((d['driver'], d) for d in node.drivers)
+                if [(d['driver'], d['uom']) for d in drivers] == \
+                        [(d['driver'], d['uom']) for d in node.drivers]:
+                    continue
+                LOGGER.info("Updating %s node" % self.node_name(name))
+                for d in drivers:
+                    if d['driver'] in current and current[d['driver']]['uom'] == d['uom']:
+                        d['value'] = current[d['driver']]['value']
+                node.drivers = drivers
+                node.SetUnits(units)
+                self.controller.addNode(node, update=True)
+                continue
 
+            LOGGER.info("Creating %s node" % self.node_name(name))
+            node = node_class(self.controller, self.controller.address,
+                    address, self.node_name(name))
+            if self.name != '':
+                node.id = address
+            node.SetUnits(units)
+            node.drivers = drivers
+            self.controller.addNode(node)
+
+    def compile_plan(self):
+        # Flatten the per-node maps into a single list of
+        # (node, driver, field index, converter, deadband, window) entries.
+        # Everything that doesn't change from packet to packet (node
+        # lookup, field index, unit conversion) is resolved here so the
+        # receive loop only has to run the plan.
+        nodes = self.controller.nodes
+        old = {}          # windows of unchanged fields are kept
+        for (node, driver, index, convert, deadband, window) in self.plan.entries:
+            if isinstance(window, aggregate.FieldWindow):
+                old[(node.address, driver, index, window.mode, window.capacity)] = window
+        plan = []
+        plan_nodes = []
+        samplers = []
+        windows = {}      # (node name, driver) -> window of raw samples
+        calculated = []
+        tracked = []
+        fields_of = {}    # node address -> {driver: field index}
+        capacity = max(1, int(self.controller.publish_interval)) * 2
+        defaults = {}
+        for key, mode in aggregate.DEFAULT_MODES.items():
+            (name, field) = key.split('-')
+            defaults[(name, write_profile.NODE_DRVS[name][field])] = mode
+        for (address, node_class, node_map), (base, n) in zip(
+                self.node_maps(), self.NODES):
+            if address not in nodes:
+                continue
+            node = nodes[address]
+            plan_nodes.append(node)
+            fields = {}
+            for d in node_map:
+                convert = uom.converter(d[2])
+                deadband = self.deadbands.get((base, d[0]), 0)
+                if d[1] == 'derived':
+                    # Value is calculated rather than read from a WD field,
+                    # resolved below once all the raw windows exist.
+                    calculated.append((node, base, d[0], convert, deadband))
+                    continue
+                if d[1] == 'extreme':
+                    tracked.append((node, base, d[0], convert, deadband))
+                    continue
+                try:
+                    index = int(d[1])
+                except ValueError:
+                    LOGGER.error('Invalid field number %s for %s driver %s' %
+                            (d[1], address, d[0]))
+                    continue
+                mode = self.aggregates.get((base, d[0]),
+                        defaults.get((base, d[0]), 'last'))
+                window = old.get((address, d[0], index, mode, capacity))
+                if window is None:
+                    window = aggregate.FieldWindow(mode, capacity)
+                plan.append((node, d[0], index, convert, deadband, window))
+                windows[(base, d[0])] = window
+                fields[d[0]] = index
+            node.heartbeat = self.controller.heartbeat
+            samplers.extend(node.samplers(fields))
+            fields_of[node.address] = fields
+
+        for (node, base, driver, convert, deadband) in calculated:
+            window = node.derived(driver)
+            if window is None:
+                window = self.derived_window(base, driver, windows)
+            if window is None:
+                LOGGER.error('No calculated value for %s driver %s' %
+                        (node.address, driver))
+                continue
+            plan.append((node, driver, None, convert, deadband, window))
+
+        # Highs and lows are tracked from every sample of the raw field.
+        # Nodes are kept across configuration changes, so a tracker is
+        # replaced (keeping what it has seen) when its periods change and
+        # dropped when its field is no longer tracked.
+        trackers = dict((node, {}) for node in plan_nodes)
+        for (node, base, driver, convert, deadband) in tracked:
+            (source, period, kind, periods) = self.extreme_sources[(base, driver)]
+            index = fields_of[node.address].get(source)
+            if index is None:
+                LOGGER.error('No field to track %s driver %s from' %
+                        (node.address, driver))
+                continue
+            tracker = trackers[node].get(source) or node.extremes.get(source)
+            if tracker is None or list(tracker.periods) != list(periods):
+                old = tracker
+                tracker = extremes.Extremes(periods)
+                if old is not None:
+                    tracker.set_state(old.get_state())
+            trackers[node][source] = tracker
+            if (tracker.push, index) not in samplers:
+                samplers.append((tracker.push, index))
+            plan.append((node, driver, None, convert, deadband,
+                extremes.Extreme(tracker, period, kind)))
+
+        for node in plan_nodes:
+            node.extremes = trackers[node]
+
+        LOGGER.info('Compiled plan with %d fields.' % len(plan))
+        samplers = tuple([(p[5].push, p[2]) for p in plan if p[2] is not None] + samplers)
+        last_index = max([s[1] for s in samplers] + [-1])
+        recorded = ()
+        store = self.controller.history
+        if store is not None:
+            recorded = tuple((store.series_id(p[0].address + '/' + p[1]), p[2])
+                    for p in plan if p[2] is not None)
+
+        # One assignment, the packet handler never sees half a plan.
+        indexes = tuple(sorted(set(s[1] for s in samplers)))
+        gaps = tuple((p[5].skip, p[2]) for p in plan if p[2] is not None)
+        self.plan = Plan(tuple(plan), tuple(plan_nodes), samplers, last_index,
+                recorded, indexes, gaps)
+
+    def derived_window(self, base, driver, windows):
+        # Calculate the value from the raw samples of the fields it depends
+        # on (see derived.METRICS); those fields must be mapped.
+        if (base, driver) not in derived.METRICS:
+            return None
+        (func, inputs) = derived.METRICS[(base, driver)]
+        sources = []
+        for name in inputs:
+            if derived.SOURCES[name] not in windows:
+                LOGGER.error('%s driver %s needs %s-main mapped' %
+                        (base, driver, derived.SOURCES[name][0]))
+                return None
+            sources.append(windows[derived.SOURCES[name]])
+        extra = (self.elevation,) if func is derived.sealevel else ()
+        mode = self.aggregates.get((base, driver), 'mean')
+        return derived.DerivedWindow(func, sources, mode, extra)
+
+    def publish(self, now):
+        # Reduce each field's window to a single value and send it on.
+        # Windows are reset after all the values are read since calculated
+        # values use the raw windows of other fields. A value that can't be
+        # published is logged and skipped, the windows are still reset and
+        # the nodes flushed so one bad value can't stall the rest.
+        plan = self.plan
+        for node, driver, index, convert, deadband, window in plan.entries:
+            try:
+                value = window.value()
+                if value is None:
+                    continue
+                node.update(driver, convert(value), deadband, now)
+            except (ArithmeticError, ValueError, TypeError) as e:
+                LOGGER.error('Unable to publish %s driver %s: %s' %
+                        (node.address, driver, e))
+
+        for entry in plan.entries:
+            entry[5].reset()
+
+        for node in plan.nodes:
+            node.flush()
 
-class TemperatureNode(polyinterface.Node):
+    def remove_old_nodes(self):
+        for (address, node_class, node_map) in self.node_maps():
+            if len(node_map) == 0:
+                LOGGER.info('Deleting orphaned %s node' % address)
+                self.controller.delNode(address)
+
+    def udp_data(self, data, addr):
+        # Data from Weather Display is being sent every second, that's
+        # way to fast to send on to the ISY.  Every packet is added to
+        # the aggregation windows and the windows are published once
+        # per publish interval.
+        #
+        # data is the packet as queued by the receiver, it isn't copied
+        # again here.
+        #
+        # Bad packets are rejected, and counted, by checks up front rather
+        # than by catching exceptions part way through.
+        m = self.controller.metrics
+        if self.senders and addr[0] not in self.senders:
+            m.reject('sender')
+            return
+
+        m.packets += 1
+        plan = self.plan
+        t0 = time.perf_counter()
+        fields = self.parse(data, plan)
+        reason = self.validate(fields, plan)
+        if reason is not None:
+            m.reject(reason)
+            LOGGER.debug('Rejected packet from %s: %s' % (addr[0], reason))
+            return
+        t1 = time.perf_counter()
+        self.sample(fields, plan)
+        t2 = time.perf_counter()
+        m.parse.add(t1 - t0)
+        m.convert.add(t2 - t1)
+
+        now = time.time()
+        if self.journal is not None:
+            if not self.journal.append(now, data):
+                m.truncated += 1
+                LOGGER.debug('Packet from %s truncated in the journal' % addr[0])
+
+        if plan.history:
+            self.controller.history.add(now,
+                    [(sid, float(fields[index])) for sid, index in plan.history
+                        if fields[index] not in MISSING])
+
+    def parse(self, data, plan=None):
+        # Split only as far as the highest mapped field; the rest of the
+        # packet is left as one unsplit tail. Fields stay as bytes and
+        # only the mapped ones are converted, by sample().
+        if plan is None:
+            plan = self.plan
+        return data.split(None, max(plan.last_index, 0) + 1)
+
+    def validate(self, fields, plan=None):
+        # Reason the packet can't be used, or None if it's good. After
+        # this every mapped field is a number or a placeholder.
+        if plan is None:
+            plan = self.plan
+        if len(fields) <= max(plan.last_index, 0):
+            return 'short'
+        if fields[0] != HEADER:
+            return 'header'
+        number = NUMBER.match
+        isfinite = math.isfinite
+        for index in plan.indexes:
+            value = fields[index]
+            if value in MISSING:
+                continue
+            if number(value) is None or not isfinite(float(value)):
+                return 'number'
+        return None
+
+    def sample(self, fields, plan=None):
+        # Placeholders aren't sampled. The raw windows record a gap
+        # instead so calculated values, which pair up the windows' samples,
+        # don't combine values from different packets.
+        if plan is None:
+            plan = self.plan
+        missing = 0
+        for push, index in plan.samplers:
+            value = fields[index]
+            if value in MISSING:
+                missing += 1
+                continue
+            push(float(value))
+        if missing:
+            self.controller.metrics.missing += missing
+            for skip, index in plan.gaps:
+                if fields[index] in MISSING:
+                    skip()
+
+
+class SensorNode(polyinterface.Node):
+    """
+    Common base for the sensor nodes. Values are only reported to the ISY
+    when they move by more than the driver's deadband or when the driver
+    hasn't been reported for heartbeat seconds.
+
+    Changes are collected by update() and sent together by flush() at the
+    end of each publish cycle.
+    """
+    heartbeat = 600
+
+    def __init__(self, controller, primary, address, name):
+        super(SensorNode, self).__init__(controller, primary, address, name)
+        self.reported = {}  # driver -> (value, time) of last report
+        self.latest = {}    # driver -> last aggregated value, reported or not
+        self.pending = {}   # driver -> value waiting for flush()
+        self.extremes = {}  # driver -> extremes.Extremes tracking it
+        self.dirty = False
+
+    def update(self, driver, value, deadband, now):
+        self.latest[driver] = value
+        last = self.reported.get(driver)
+        if last is not None:
+            delta = abs(value - last[0])
+            if (delta == 0 or delta < deadband) and (now - last[1]) < self.heartbeat:
+                return
+        self.reported[driver] = (value, now)
+        self.pending[driver] = value
+        self.dirty = True
+
+    def derived(self, driver):
+        # Nodes that can calculate a driver's value return an object with
+        # value() and reset() methods, like aggregate.FieldWindow.
+        return None
+
+    def samplers(self, fields):
+        # Extra (push, field index) pairs needed to feed calculated values.
+        # fields maps driver to WD field index for the mapped drivers.
+        return []
+
+    def stateful(self):
+        # (name, object) pairs with state to save across restarts, see
+        # state.py. The node itself saves the last reported values.
+        return [('reported', self)] + [('extremes-' + d, t)
+                for d, t in self.extremes.items()]
+
+    def get_state(self):
+        return dict((d, list(r)) for d, r in self.reported.items())
+
+    def set_state(self, saved):
+        for d in self.drivers:
+            if d['driver'] in saved:
+                (value, when) = saved[d['driver']]
+                self.reported[d['driver']] = (value, when)
+                d['value'] = value
+
+    def flush(self):
+        # Apply all the pending values, save the driver state once and
+        # send a status for each driver that was updated.
+        if not self.pending:
+            return 0
+
+        changed = []
+        pending = self.pending
+        self.pending = {}
+        for d in self.drivers:
+            if d['driver'] in pending:
+                d['value'] = pending.pop(d['driver'])
+                changed.append(d)
+        self.updateDrivers(self.drivers)
+
+        for d in changed:
+            self.controller.poly.send({'status': {
+                'address': self.address,
+                'driver': d['driver'],
+                'value': str(d['value']),
+                'uom': d['uom']
+                }})
+        return len(changed)
+
+
+class TemperatureNode(SensorNode):
     id = 'temperature'
     hint = 0xffffff
     units = 'metric'
@@ -457,58 +1344,25 @@ class TemperatureNode(polyinterface.Node):
     def SetUnits(self, u):
         self.units = u
 
+    # Scalar versions of the calculations in derived.py. Wind speed is
+    # in knots.
     def Dewpoint(self, t, h):
-        b = (17.625 * t) / (243.04 + t)
-        rh = h / 100.0
-        c = math.log(rh)
-        dewpt = (243.04 * (c + b)) / (17.625 - c - b)
-        return round(dewpt, 1)
+        return round(derived.dewpoint(derived.SCALAR, t, h), 1)
 
+    # ws is in m/s, derived works in knots like the packet.
     def ApparentTemp(self, t, ws, h):
-        wv = h / 100.0 * 6.105 * math.exp(17.27 * t / (237.7 + t))
-        at =  t + (0.33 * wv) - (0.70 * ws) - 4.0
-        return round(at, 1)
+        knots = ws / derived.KNOTS_TO_MS
+        return round(derived.apparent(derived.SCALAR, t, knots, h), 1)
 
     def Windchill(self, t, ws):
-        # really need temp in F and speed in MPH
-        tf = (t * 1.8) + 32
-        mph = ws / 0.44704
-
-        wc = 35.74 + (0.6215 * tf) - (35.75 * math.pow(mph, 0.16)) + (0.4275 * tf * math.pow(mph, 0.16))
-
-        if (tf <= 50.0) and (mph >= 5.0):
-            return round((wc - 32) / 1.8, 1)
-        else:
-            return t
+        knots = ws / derived.KNOTS_TO_MS
+        return round(derived.windchill(derived.SCALAR, t, knots), 1)
 
     def Heatindex(self, t, h):
-        tf = (t * 1.8) + 32
-        c1 = -42.379
-        c2 = 2.04901523
-        c3 = 10.1433127
-        c4 = -0.22475541
-        c5 = -6.83783 * math.pow(10, -3)
-        c6 = -5.481717 * math.pow(10, -2)
-        c7 = 1.22874 * math.pow(10, -3)
-        c8 = 8.5282 * math.pow(10, -4)
-        c9 = -1.99 * math.pow(10, -6)
-
-        hi = (c1 + (c2 * tf) + (c3 * h) + (c4 * tf * h) + (c5 * tf *tf) + (c6 * h * h) + (c7 * tf * tf * h) + (c8 * tf * h * h) + (c9 * tf * tf * h * h))
-
-        if (tf < 80.0) or (h < 40.0):
-            return t
-        else:
-            return round((hi - 32) / 1.8, 1)
-
-    def setDriver(self, driver, value):
-        if (self.units == "us"):
-            value = (value * 1.8) + 32  # convert to F
-
-        super(TemperatureNode, self).setDriver(driver, round(value, 1), report=True, force=True)
-
+        return round(derived.heatindex(derived.SCALAR, t, h), 1)
 
 
-class HumidityNode(polyinterface.Node):
+class HumidityNode(SensorNode):
     id = 'humidity'
     hint = 0xffffff
     units = 'metric'
@@ -517,63 +1371,47 @@ class HumidityNode(polyinterface.Node):
     def SetUnits(self, u):
         self.units = u
 
-    def setDriver(self, driver, value):
-        super(HumidityNode, self).setDriver(driver, value, report=True, force=True)
 
-class PressureNode(polyinterface.Node):
+class PressureNode(SensorNode):
     id = 'pressure'
     hint = 0xffffff
     units = 'metric'
     drivers = [ ]
-    mytrend = []
 
+    def __init__(self, controller, primary, address, name):
+        super(PressureNode, self).__init__(controller, primary, address, name)
+        self.trend = trend.PressureTrend()
 
     def SetUnits(self, u):
         self.units = u
 
     # convert station pressure in millibars to sealevel pressure
     def toSeaLevel(self, station, elevation):
-        i = 287.05
-        a = 9.80665
-        r = 0.0065
-        s = 1013.35 # pressure at sealevel
-        n = 288.15
+        return round(derived.sealevel(derived.SCALAR, station, elevation), 3)
 
-        l = a / (i * r)
-        c = i * r / a
-        u = math.pow(1 + math.pow(s / station, c) * (r * elevation / n), l)
+    # track pressures and calculate the 3 hour trend (-1, 0, 1)
+    def updateTrend(self, current, now=None):
+        self.trend.push(current, now)
+        return self.trend.classify()
 
-        return (round((station * u), 3))
+    # pressure-trend = derived publishes the 3 hour change calculated from
+    # the station (or sea level) pressure.
+    def derived(self, driver):
+        if driver == 'GV1':
+            return self.trend
+        return None
 
-    # track pressures in a queue and calculate trend
-    def updateTrend(self, current):
-        t = 0
-        past = 0
+    def samplers(self, fields):
+        for driver in ('ST', 'GV0'):
+            if driver in fields:
+                return [(self.trend.push, fields[driver])]
+        return []
 
-        if len(self.mytrend) == 180:
-            past = self.mytrend.pop()
+    def stateful(self):
+        return SensorNode.stateful(self) + [('trend', self.trend)]
 
-        if self.mytrend != []:
-            past = self.mytrend[0]
 
-        # calculate trend
-        if ((past - current) > 1):
-            t = -1
-        elif ((past - current) < -1):
-            t = 1
-
-        self.mytrend.insert(0, current)
-        return t
-
-    # We want to override the SetDriver method so that we can properly
-    # convert the units based on the user preference.
-    def setDriver(self, driver, value):
-        if (self.units == 'us'):
-            value = round(value * 0.02952998751, 3)
-        super(PressureNode, self).setDriver(driver, value, report=True, force=True)
-
-
-class WindNode(polyinterface.Node):
+class WindNode(SensorNode):
     id = 'wind'
     hint = 0xffffff
     units = 'metric'
@@ -582,73 +1420,52 @@ class WindNode(polyinterface.Node):
     def SetUnits(self, u):
         self.units = u
 
-    # Convert from Knots to MPH or KM/H as appropriate
-    def setDriver(self, driver, value):
-        if (driver == 'ST' or driver == 'GV1' or driver == 'GV3' or driver == 'GV4'):
-            if (self.units != 'metric'):
-                value = round(value * 1.15077945, 2)
-            else:
-                value = round(value * 1.852, 2)
-        super(WindNode, self).setDriver(driver, value, report=True, force=True)
 
-class PrecipitationNode(polyinterface.Node):
+class PrecipitationNode(SensorNode):
     id = 'precipitation'
     hint = 0xffffff
     units = 'metric'
     drivers = [ ]
-    hourly_rain = 0
-    daily_rain = 0
-    weekly_rain = 0
-    monthly_rain = 0
-    yearly_rain = 0
 
-    prev_hour = 0
-    prev_day = 0
-    prev_week = 0
+    # Accumulated totals that can be calculated, driver -> period
+    TOTALS = {
+            'GV0' : 'hour',
+            'GV1' : 'day',
+            'GV2' : 'week',
+            'GV3' : 'month',
+            'GV4' : 'year',
+            'GV6' : 'yesterday',
+            }
+
+    def __init__(self, controller, primary, address, name):
+        super(PrecipitationNode, self).__init__(controller, primary, address, name)
+        self.rain = rain.RainAccumulator()
 
     def SetUnits(self, u):
         self.units = u
 
-    def hourly_accumulation(self, r):
-        current_hour = datetime.datetime.now().hour
-        if (current_hour != self.prev_hour):
-            self.prev_hour = current_hour
-            self.hourly = 0
-
-        self.hourly_rain += r
-        return self.hourly_rain
-
-    def daily_accumulation(self, r):
-        current_day = datetime.datetime.now().day
-        if (current_day != self.prev_day):
-            self.prev_day = current_day
-            self.daily_rain = 0
-
-        self.daily_rain += r
-        return self.daily_rain
-
-    def weekly_accumulation(self, r):
-        current_week = datetime.datetime.now().day
-        if (current_weekday != self.prev_weekday):
-            self.prev_week = current_weekday
-            self.weekly_rain = 0
-
-        self.weekly_rain += r
-        return self.weekly_rain
-
-        
-    def setDriver(self, driver, value):
-        if (driver == 'ST') or (driver == 'GV5'):
-            if (self.units == 'us'):
-                value = round(value * 2.362, 3)
-            else:
-                value = round(value * 60, 3)
-        else:
-            if (self.units == 'us'):
-                value = round(value * 0.03937, 2)
-        super(PrecipitationNode, self).setDriver(driver, value, report=True, force=True)
+    # rain-hourly = derived (and the other totals) publish the rain
+    # accumulated by the node itself.
+    def derived(self, driver):
+        if driver in self.TOTALS:
+            return rain.Total(self.rain, self.TOTALS[driver])
+        return None
+
+    def samplers(self, fields):
+        # Prefer a rain counter from WD, the daily total is the most
+        # commonly available, otherwise integrate the rain rate.
+        for driver in ('GV1', 'GV0', 'GV2', 'GV3', 'GV4'):
+            if driver in fields:
+                return [(self.rain.push_counter, fields[driver])]
+        if 'ST' in fields:
+            return [(self.rain.push_rate, fields['ST'])]
+        return []
 
-class LightNode(polyinterface.Node):
+    def stateful(self):
+        return SensorNode.stateful(self) + [('rain', self.rain)]
+
+
+class LightNode(SensorNode):
     id = 'light'
     units = 'metric'
     hint = 0xffffff
@@ -657,10 +1474,8 @@ class LightNode(polyinterface.Node):
     def SetUnits(self, u):
         self.units = u
 
-    def setDriver(self, driver, value):
-        super(LightNode, self).setDriver(driver, value, report=True, force=True)
 
-class LightningNode(polyinterface.Node):
+class LightningNode(SensorNode):
     id = 'lightning'
     hint = 0xffffff
     units = 'metric'
@@ -669,12 +1484,6 @@ class LightningNode(polyinterface.Node):
     def SetUnits(self, u):
         self.units = u
 
-    def setDriver(self, driver, value):
-        if (driver == 'GV0'):
-            if (self.units != 'metric'):
-                value = round(value / 1.609344, 1)
-        super(LightningNode, self).setDriver(driver, value, report=True, force=True)
-
 
 if __name__ == "__main__":
     try:
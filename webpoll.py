@@ -0,0 +1,117 @@
+# Remote clientraw.txt input
+#
+# Weather Display usually uploads clientraw.txt (and clientrawextra.txt)
+# to a web server for its web pages. Polling those lets a station be
+# monitored from anywhere the web server can be reached, without the
+# multicast packets having to reach this machine.
+#
+# All the polled stations share one urllib3 PoolManager so each server's
+# connection is kept open between polls. Requests are conditional, with
+# If-None-Match / If-Modified-Since from the last response, so a file
+# that hasn't been uploaded again costs a 304 and no body. Each poll is
+# rescheduled with some jitter so stations polled at the same interval
+# don't end up hitting their servers in lock step.
+#
+# When clientrawextra.txt is also polled its fields are appended to the
+# clientraw.txt fields starting at field EXTRA_BASE, so field 12 of
+# clientrawextra.txt is mapped as field 1012.
+
+import random
+import zlib
+import receiver
+
+EXTRA_BASE = 1000
+
+# Fraction of the interval each poll is moved by, at random.
+JITTER = 0.1
+
+# Largest file accepted.
+MAX_SIZE = 65536
+
+_pool = None
+
+
+def pool():
+    # The shared connection pool, urllib3 is only loaded when it's used.
+    global _pool
+    if _pool is None:
+        import urllib3
+        _pool = urllib3.PoolManager(num_pools=8, maxsize=2, block=False,
+                retries=False, timeout=urllib3.Timeout(connect=5.0, read=10.0),
+                headers={'User-Agent': 'wdpoly', 'Accept-Encoding': 'gzip'})
+    return _pool
+
+
+class Document(object):
+    """ One remote file and the validators of its last response. """
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.modified = None
+        self.data = None
+
+    def fetch(self):
+        # True if the file changed since the last fetch.
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.modified is not None:
+            headers['If-Modified-Since'] = self.modified
+        r = pool().request('GET', self.url, headers=headers)
+        if r.status == 304:
+            return False
+        if r.status != 200:
+            raise IOError('%s returned %d' % (self.url, r.status))
+        if len(r.data) > MAX_SIZE:
+            raise IOError('%s is too large' % self.url)
+        self.etag = r.headers.get('ETag')
+        self.modified = r.headers.get('Last-Modified')
+        self.data = r.data
+        return True
+
+
+class WebSource(receiver.Input):
+    """ A polled clientraw.txt. """
+    def __init__(self, url, handler, interval=10.0, extra=False):
+        super(WebSource, self).__init__(url, handler)
+        self.url = url
+        self.interval = interval
+        self.main = Document(url)
+        self.extra = None
+        if extra:
+            self.extra = Document(url.rsplit('/', 1)[0] + '/clientrawextra.txt')
+        self.crc = None
+        self.polls = 0
+        self.unchanged = 0  # polls with nothing new
+
+    def delay(self):
+        # Seconds to the next poll.
+        return self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def read(self):
+        """
+        Poll the file(s), blocking. Returns the combined fields if
+        anything changed, otherwise None.
+        """
+        self.polls += 1
+        changed = self.main.fetch()
+        if self.extra is not None:
+            changed = self.extra.fetch() or changed
+        if not changed or self.main.data is None:
+            self.unchanged += 1
+            return None
+
+        data = self.main.data
+        if self.extra is not None and self.extra.data is not None:
+            fields = data.split()
+            fields.extend([b'--'] * (EXTRA_BASE - len(fields)))
+            data = b' '.join(fields[:EXTRA_BASE]) + b' ' + self.extra.data
+
+        # Some servers don't send validators, or the file is uploaded
+        # again unchanged.
+        crc = zlib.crc32(data)
+        if crc == self.crc:
+            self.unchanged += 1
+            return None
+        self.crc = crc
+        return data
@@ -3,12 +3,18 @@
 import collections
 import re
 import os
-import zipfile
 import json
+import hashlib
 
 pfx = "write_profile:"
 
 VERSION_FILE = "profile/version.txt"
+HASH_FILE = "profile.hash"
+NLS_FILE = "profile/nls/en_us.txt"
+
+# Everything after this line in the NLS file is generated for the drivers
+# that are allocated at run time (see build_nls).
+NLS_MARKER = "# Generated by the node server, changes below this line are lost"
 
 # define templates for the various sensor nodes we have available. Each
 # sensor node will have a pre-defined list of drivers. When we build
@@ -111,6 +117,20 @@ LTNG_DRVS = {
         'distance' : 'GV0'
         }
 
+# Highest GVn driver the ISY supports.
+MAX_GV = 30
+
+# Driver tables indexed by the node name used in the configuration keys.
+NODE_DRVS = {
+        'temperature' : TEMP_DRVS,
+        'humidity' : HUMD_DRVS,
+        'pressure' : PRES_DRVS,
+        'wind' : WIND_DRVS,
+        'rain' : RAIN_DRVS,
+        'light' : LITE_DRVS,
+        'lightning' : LTNG_DRVS,
+        }
+
 
 NODEDEF_TMPL = "  <nodeDef id=\"%s\" nodeType=\"139\" nls=\"%s\">\n"
 STATUS_TMPL = "      <st id=\"%s\" editor=\"%s\" />\n"
@@ -122,107 +142,173 @@ STATUS_TMPL = "      <st id=\"%s\" editor=\"%s\" />\n"
 
 def write_profile(logger, temperature_list, humidity_list, pressure_list,
         wind_list, rain_list, light_list, lightning_list):
+    nodedefs = [
+            ('temperature', '139T', TEMP_DRVS, temperature_list),
+            ('humidity', '139H', HUMD_DRVS, humidity_list),
+            ('pressure', '139P', PRES_DRVS, pressure_list),
+            ('wind', '139W', WIND_DRVS, wind_list),
+            ('precipitation', '139R', RAIN_DRVS, rain_list),
+            ('light', '139L', LITE_DRVS, light_list),
+            ('lightning', '139S', LTNG_DRVS, lightning_list)]
+    return write_nodedefs(logger, [d + ({},) for d in nodedefs])
+
+
+def write_nodedefs(logger, nodedefs):
+    """
+    Generate the node definitions and profile zip. nodedefs is a list of
+    (nodedef id, nls, driver table, editor list, extra names) for each
+    sensor node. extra names maps drivers allocated at run time to
+    (driver the name is based on, label); nodes with extra names get
+    their own NLS entries.
+    Returns the new profile's hash if it differs from the last profile
+    installed on the ISY, None if it's the same (or couldn't be written).
+    Pass the hash to save_profile_hash() once the install has worked.
+    """
     sd = get_server_data(logger)
     if sd is False:
         logger.error("Unable to complete without server data...")
-        return False
+        return None
 
-    logger.info("{0} Writing profile/nodedef/nodedefs.xml".format(pfx))
-    nodedef = open("profile/nodedef/nodedefs.xml", "w")
-    nodedef.write("<nodeDefs>\n")
+    nodedef = build_nodedef(nodedefs)
+    nls = build_nls(nodedefs)
 
-    # First, write the controller node definition
-    nodedef.write(NODEDEF_TMPL % ('WeatherDisplay', 'ctl'))
-    nodedef.write("    <sts>\n")
-    nodedef.write("      <st id=\"ST\" editor=\"bool\" />\n")
-    nodedef.write("      <st id=\"GV0\" editor=\"I_VOLTS\" />\n")
-    nodedef.write("      <st id=\"GV1\" editor=\"I_VOLTS\" />\n")
-    nodedef.write("    </sts>\n")
-    nodedef.write("    <cmds>\n")
-    nodedef.write("      <sends />\n")
-    nodedef.write("      <accepts>\n")
-    nodedef.write("        <cmd id=\"DISCOVER\" />\n")
-    nodedef.write("        <cmd id=\"REMOVE_NOTICES_ALL\" />\n")
-    nodedef.write("        <cmd id=\"UPDATE_PROFILE\" />\n")
-    nodedef.write("      </accepts>\n")
-    nodedef.write("    </cmds>\n")
-    nodedef.write("  </nodeDef>\n\n")
+    # Skip the writes, zip and install if nothing has changed.
+    digest = profile_hash(nodedef + nls, sd['profile_version'])
+    if digest == read_profile_hash() and os.path.exists('profile.zip'):
+        logger.info("{0} profile unchanged, not writing.".format(pfx))
+        return None
 
-    # Need to translate temperature.main into <st id="ST" editor="TEMP_C" />
-    # and     translate temperature.extra1 into <st id="GV5" editor="TEMP_C" />
+    logger.info("{0} Writing profile/nodedef/nodedefs.xml".format(pfx))
+    with open("profile/nodedef/nodedefs.xml", "w") as outfile:
+        outfile.write(nodedef)
 
-    if (len(temperature_list) > 0):
-        nodedef.write(NODEDEF_TMPL % ('temperature', '139T'))
-        nodedef.write("    <sts>\n")
-        for t in temperature_list:
-            nodedef.write(STATUS_TMPL % (TEMP_DRVS[t], temperature_list[t]))
-        nodedef.write("    </sts>\n")
-        nodedef.write("  </nodeDef>\n")
-
-    if (len(humidity_list) > 0):
-        nodedef.write(NODEDEF_TMPL % ('humidity', '139H'))
-        nodedef.write("    <sts>\n")
-        for t in humidity_list:
-            nodedef.write(STATUS_TMPL % (HUMD_DRVS[t], humidity_list[t]))
-        nodedef.write("    </sts>\n")
-        nodedef.write("  </nodeDef>\n")
-
-    if (len(pressure_list) > 0):
-        nodedef.write(NODEDEF_TMPL % ('pressure', '139P'))
-        nodedef.write("    <sts>\n")
-        for t in pressure_list:
-            nodedef.write(STATUS_TMPL % (PRES_DRVS[t], pressure_list[t]))
-        nodedef.write("    </sts>\n")
-        nodedef.write("  </nodeDef>\n")
-
-    if (len(wind_list) > 0):
-        nodedef.write(NODEDEF_TMPL % ('wind', '139W'))
-        nodedef.write("    <sts>\n")
-        for t in wind_list:
-            nodedef.write(STATUS_TMPL % (WIND_DRVS[t], wind_list[t]))
-        nodedef.write("    </sts>\n")
-        nodedef.write("  </nodeDef>\n")
-
-    if (len(rain_list) > 0):
-        nodedef.write(NODEDEF_TMPL % ('precipitation', '139R'))
-        nodedef.write("    <sts>\n")
-        for t in rain_list:
-            nodedef.write(STATUS_TMPL % (RAIN_DRVS[t], rain_list[t]))
-        nodedef.write("    </sts>\n")
-        nodedef.write("  </nodeDef>\n")
-
-    if (len(light_list) > 0):
-        nodedef.write(NODEDEF_TMPL % ('light', '139L'))
-        nodedef.write("    <sts>\n")
-        for t in light_list:
-            nodedef.write(STATUS_TMPL % (LITE_DRVS[t], light_list[t]))
-        nodedef.write("    </sts>\n")
-        nodedef.write("  </nodeDef>\n")
-
-    if (len(lightning_list) > 0):
-        nodedef.write(NODEDEF_TMPL % ('lightning', '139S'))
-        nodedef.write("    <sts>\n")
-        for t in lightning_list:
-            nodedef.write(STATUS_TMPL % (LTNG_DRVS[t], lightning_list[t]))
-        nodedef.write("    </sts>\n")
-        nodedef.write("  </nodeDef>\n")
-
-    nodedef.write("</nodeDefs>")
-
-    nodedef.close()
+    if nls != read_nls():
+        logger.info("{0} Writing {1}".format(pfx, NLS_FILE))
+        # The NLS file has DOS line endings, keep them.
+        with open(NLS_FILE, "w", newline="\r\n") as outfile:
+            outfile.write(nls)
 
     # Update the profile version file with the info from server.json
     with open(VERSION_FILE, 'w') as outfile:
         outfile.write(sd['profile_version'])
-    outfile.close()
 
     # Create the zip file that can be uploaded to the ISY
     write_profile_zip(logger)
 
     logger.info(pfx + " done.")
+    return digest
+
+
+def build_nodedef(nodedefs):
+    nodedef = []
+    nodedef.append("<nodeDefs>\n")
+
+    # First, write the controller node definition
+    nodedef.append(NODEDEF_TMPL % ('WeatherDisplay', 'ctl'))
+    nodedef.append("    <sts>\n")
+    nodedef.append("      <st id=\"ST\" editor=\"bool\" />\n")
+    nodedef.append("      <st id=\"GV0\" editor=\"I_COUNT\" />\n")
+    nodedef.append("      <st id=\"GV1\" editor=\"I_COUNT\" />\n")
+    nodedef.append("      <st id=\"GV2\" editor=\"I_COUNT\" />\n")
+    nodedef.append("      <st id=\"GV3\" editor=\"I_COUNT\" />\n")
+    nodedef.append("      <st id=\"GV4\" editor=\"I_MSEC\" />\n")
+    nodedef.append("      <st id=\"GV5\" editor=\"I_MSEC\" />\n")
+    nodedef.append("      <st id=\"GV6\" editor=\"I_MSEC\" />\n")
+    nodedef.append("    </sts>\n")
+    nodedef.append("    <cmds>\n")
+    nodedef.append("      <sends />\n")
+    nodedef.append("      <accepts>\n")
+    nodedef.append("        <cmd id=\"DISCOVER\" />\n")
+    nodedef.append("        <cmd id=\"REMOVE_NOTICES_ALL\" />\n")
+    nodedef.append("        <cmd id=\"UPDATE_PROFILE\" />\n")
+    nodedef.append("      </accepts>\n")
+    nodedef.append("    </cmds>\n")
+    nodedef.append("  </nodeDef>\n\n")
+
+    # Need to translate temperature.main into <st id="ST" editor="TEMP_C" />
+    # and     translate temperature.extra1 into <st id="GV5" editor="TEMP_C" />
+
+    for (node_id, nls, drvs, edit_list, extra) in nodedefs:
+        if (len(edit_list) > 0):
+            if extra:
+                nls = node_id
+            nodedef.append(NODEDEF_TMPL % (node_id, nls))
+            nodedef.append("    <sts>\n")
+            for t in edit_list:
+                nodedef.append(STATUS_TMPL % (drvs[t], edit_list[t]))
+            nodedef.append("    </sts>\n")
+            nodedef.append("  </nodeDef>\n")
+
+    nodedef.append("</nodeDefs>")
+    return "".join(nodedef)
+
+
+def read_nls():
+    try:
+        with open(NLS_FILE, 'r') as infile:
+            return infile.read()
+    except (IOError, OSError):
+        return ''
+
+
+def build_nls(nodedefs):
+    # The static NLS file with generated entries for the nodes that have
+    # extra drivers. Those nodes get an NLS of their own, named for the
+    # node id, with a copy of the static driver names plus the extra ones.
+    current = read_nls()
+    if NLS_MARKER in current:
+        static = current.split(NLS_MARKER)[0].rstrip('\n') + '\n'
+    else:
+        static = current
+    names = {}
+    for line in static.splitlines():
+        if line.startswith('ST-') and '=' in line:
+            (key, value) = line.split('=', 1)
+            names[key.strip()] = value.strip()
+
+    generated = []
+    for (node_id, nls, drvs, edit_list, extra) in nodedefs:
+        if not extra or len(edit_list) == 0:
+            continue
+        generated.append('')
+        for t in edit_list:
+            driver = drvs[t]
+            if driver in extra:
+                (base, label) = extra[driver]
+                name = names.get('ST-%s-%s-NAME' % (nls, base), base) + ' ' + label
+            else:
+                name = names.get('ST-%s-%s-NAME' % (nls, driver), driver)
+            generated.append('ST-%s-%s-NAME = %s' % (node_id, driver, name))
+
+    if not generated:
+        return static
+    return static.rstrip('\n') + '\n\n' + NLS_MARKER + '\n'.join(generated) + '\n'
+
+
+def profile_hash(nodedef, version):
+    h = hashlib.sha256()
+    h.update(version.encode('utf-8'))
+    h.update(nodedef.encode('utf-8'))
+    return h.hexdigest()
+
+
+def read_profile_hash():
+    try:
+        with open(HASH_FILE, 'r') as infile:
+            return infile.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def save_profile_hash(digest):
+    # Only once the profile is on the ISY, so a failed install is retried.
+    with open(HASH_FILE, 'w') as outfile:
+        outfile.write(digest)
 
 
 def write_profile_zip(logger):
+    # Only needed when the profile changes, so not imported at startup.
+    import zipfile
     src = 'profile'
     abs_src = os.path.abspath(src)
     with zipfile.ZipFile('profile.zip', 'w') as zf: